@@ -1,20 +1,22 @@
 
-import os
 import typer
 import asyncio
 from .main import start_services, stop_services
 
 app = typer.Typer()
-PID_FILE = "/tmp/pi_gate.pid"
 
 @app.command()
 def start():
     """Start pi-gate services in the background"""
-    if os.path.exists(PID_FILE):
+    try:
+        started = asyncio.run(start_services())
+    except RuntimeError as e:
+        print(f"pi-gate could not start: {e}")
+        raise typer.Exit(1)
+    if not started:
         print("pi-gate is already running!")
         raise typer.Exit(1)
 
-    asyncio.run(start_services())
     print("pi-gate started successfully.")
 
 @app.command()
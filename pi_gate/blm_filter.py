@@ -1,14 +1,332 @@
 import sys
-import requests
+import math
+import bisect
+import functools
+import asyncio
+import aiohttp
 import logging
+import logging.handlers
 import os
-import time
-import pickle
 import re
+import time
+import struct
+import mmh3
+import numpy as np
 from pathlib import Path
-from typing import Optional, List, Tuple
-from pybloom_live import BloomFilter
-from urllib.parse import urlparse
+from typing import Optional, List, Tuple, Sequence, Union
+
+_MASK64 = (1 << 64) - 1
+
+# One blocklist entry per line, in either format:
+#   "0.0.0.0 domain.com" / "127.0.0.1 domain.com" / ":: domain.com"
+#   "domain.com"
+# Comment and blank lines never match. Run over the lowercased body, the
+# capture is already normalized the way normalize_url() does it: scheme,
+# "www.", path and trailing dots are left outside the group.
+_HOST_ENTRY = re.compile(rb'(?m)^[ \t]*(?:(?:\d+\.\d+\.\d+\.\d+|::1?)[ \t]+)?'
+                         rb'(?:[a-z]+://)?(?:www\.)?([^\s#/]*[^\s#/.])')
+
+# Saved filters are a single file: a fixed-size header followed by the raw
+# arrays, so loading is one memory map with nothing to parse
+_FILE_HEADER_SIZE = 64
+_BLOOM_HEADER = struct.Struct('<4sQdQIQ')  # magic, capacity, error rate, bits, hashes, count
+_HASH_SET_HEADER = struct.Struct('<4sIQ')  # magic, bucket bits, count
+_BLOOM_MAGIC = b'PGBF'
+_HASH_SET_MAGIC = b'PGHS'
+
+def _write_blob(path: Path, header: bytes, *arrays: np.ndarray) -> None:
+    """
+    Replace path with header, padded to _FILE_HEADER_SIZE, followed by arrays.
+    
+    The data is written to a temporary file that is renamed over path, so
+    processes still mapping the old file keep a consistent copy of it.
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(_FILE_HEADER_SIZE, b'\0'))
+        for array in arrays:
+            array.tofile(f)
+    os.replace(tmp_path, path)
+
+def _write_tlds(path: Path, tlds: frozenset) -> None:
+    """Replace path with the given TLDs, one per line, the same way _write_blob does."""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\n'.join(sorted(tlds)))
+    os.replace(tmp_path, path)
+
+def _read_tlds(path: Path) -> Optional[frozenset]:
+    """Return the TLDs saved by _write_tlds, or None if there is no such file."""
+    try:
+        with open(path, 'rb') as f:
+            return frozenset(f.read().split(b'\n'))
+    except FileNotFoundError:
+        return None
+
+def _read_header(path: Path, header: struct.Struct, magic: bytes) -> tuple:
+    """Return the fields after the magic of a header written by _write_blob."""
+    with open(path, 'rb') as f:
+        fields = header.unpack(f.read(header.size))
+    if fields[0] != magic:
+        raise ValueError(f"Unrecognized filter file {path}")
+    return fields[1:]
+
+class BloomFilter:
+    """
+    A Bloom filter backed by a numpy bit array.
+
+    Each key is hashed once with 64-bit MurmurHash3 and the k bit positions
+    are derived by double hashing, so bulk inserts run as numpy operations.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        """
+        Size the filter for the given capacity and false positive rate.
+
+        Args:
+            capacity: The expected number of entries
+            error_rate: Acceptable false positive rate (0.001 = 0.1%)
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        # Single lookups index through a memoryview, which yields plain ints
+        # instead of numpy scalars
+        self._view = memoryview(self.bits)
+        self.count = 0
+
+    def _indexes(self, keys: Sequence[Union[str, bytes]]) -> np.ndarray:
+        """Return a (len(keys), num_hashes) array of bit positions."""
+        hashes = np.array([mmh3.hash64(key, signed=False) for key in keys], dtype=np.uint64)
+        h1 = hashes[:, 0:1]
+        h2 = hashes[:, 1:2]
+        # uint64 arithmetic wraps, matching the masking done in __contains__
+        rounds = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1 + rounds * h2) % np.uint64(self.num_bits)
+
+    def add_many(self, keys: Sequence[Union[str, bytes]]) -> None:
+        """Add a batch of keys to the filter."""
+        if not keys:
+            return
+        idx = self._indexes(keys).ravel()
+        masks = (np.uint64(1) << (idx & np.uint64(7))).astype(np.uint8)
+        np.bitwise_or.at(self.bits, idx >> np.uint64(3), masks)
+        self.count += len(keys)
+
+    def add(self, key: Union[str, bytes]) -> None:
+        """Add a single key to the filter."""
+        self.add_many([key])
+
+    def contains_many(self, keys: Sequence[Union[str, bytes]]) -> np.ndarray:
+        """Return a boolean array telling which keys may be in the filter."""
+        if not keys:
+            return np.zeros(0, dtype=bool)
+        idx = self._indexes(keys)
+        shifts = (idx & np.uint64(7)).astype(np.uint8)
+        return ((self.bits[idx >> np.uint64(3)] >> shifts) & 1).all(axis=1)
+
+    def __contains__(self, key: Union[str, bytes]) -> bool:
+        h, step = mmh3.hash64(key, signed=False)
+        bits = self._view
+        num_bits = self.num_bits
+        for _ in range(self.num_hashes):
+            idx = h % num_bits
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+            h = (h + step) & _MASK64
+        return True
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def save(self, path: Path) -> None:
+        """
+        Write the filter as a small binary header followed by the raw bit array.
+        
+        Args:
+            path: Base path; the '.bin' file is written next to it
+        """
+        header = _BLOOM_HEADER.pack(_BLOOM_MAGIC, self.capacity, self.error_rate,
+                                    self.num_bits, self.num_hashes, self.count)
+        _write_blob(path.with_suffix('.bin'), header, self.bits)
+
+    @classmethod
+    def load(cls, path: Path) -> "BloomFilter":
+        """
+        Attach to a filter written by save() without copying it.
+        
+        The bit array is memory-mapped read-only, so loading is cheap and
+        the pages are shared with any other process mapping the same file.
+        
+        Args:
+            path: Base path the filter was saved under
+            
+        Returns:
+            A read-only BloomFilter
+        """
+        path = path.with_suffix('.bin')
+        bloom = cls.__new__(cls)
+        (bloom.capacity, bloom.error_rate, bloom.num_bits,
+         bloom.num_hashes, bloom.count) = _read_header(path, _BLOOM_HEADER, _BLOOM_MAGIC)
+        bloom.bits = np.memmap(path, dtype=np.uint8, mode='r', offset=_FILE_HEADER_SIZE,
+                               shape=((bloom.num_bits + 7) // 8,))
+        bloom._view = memoryview(bloom.bits)
+        return bloom
+
+class HashSet:
+    """
+    An exact membership set of MurmurHash3 values in a compact static table.
+
+    The top 16 bits of each 64-bit hash select a bucket and the next 32 bits
+    are kept sorted within it, so the table is a bucket offset array plus
+    4 bytes per entry. With 48 hash bits compared, false positives need a
+    hash collision (~1e-9 per lookup for 600k entries) instead of the bloom
+    filter's 0.1%.
+    """
+
+    BATCH_SIZE = 10000
+    BUCKET_BITS = 16
+    error_rate = 0.0
+
+    def __init__(self):
+        self._set_table(np.zeros((1 << self.BUCKET_BITS) + 1, dtype=np.uint32),
+                        np.zeros(0, dtype=np.uint32))
+        self._pending = []
+
+    def _set_table(self, offsets: np.ndarray, suffixes: np.ndarray) -> None:
+        self.offsets = offsets
+        self.suffixes = suffixes
+        # Single lookups go through memoryviews, which yield plain ints
+        self._offsets_view = memoryview(offsets)
+        self._suffixes_view = memoryview(suffixes)
+        # Full (bucket, suffix) keys for batch lookups, built on first use
+        self._keys = None
+
+    def _table_keys(self) -> np.ndarray:
+        """Return the sorted (bucket << 32 | suffix) keys of the whole table.
+
+        The table stores the bucket implicitly, so it is expanded once and
+        kept until the table changes.
+        """
+        if self._keys is None:
+            buckets = np.repeat(np.arange(1 << self.BUCKET_BITS, dtype=np.uint64), np.diff(self.offsets))
+            self._keys = (buckets << np.uint64(32)) | self.suffixes
+        return self._keys
+
+    @classmethod
+    def _split(cls, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Split 64-bit hashes into (bucket, 32-bit suffix) arrays."""
+        buckets = (hashes >> np.uint64(64 - cls.BUCKET_BITS)).astype(np.int64)
+        suffixes = ((hashes >> np.uint64(32 - cls.BUCKET_BITS)) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        return buckets, suffixes
+
+    @staticmethod
+    def _hashes(keys: Sequence[Union[str, bytes]]) -> np.ndarray:
+        return np.fromiter(
+            (mmh3.hash64(key, signed=False)[0] for key in keys),
+            dtype=np.uint64, count=len(keys)
+        )
+
+    def _merge_pending(self) -> None:
+        """Rebuild the table with the batches added since the last lookup."""
+        if not self._pending:
+            return
+        buckets, suffixes = self._split(np.concatenate(self._pending))
+        # Bring back the entries already in the table
+        old_buckets = np.repeat(np.arange(1 << self.BUCKET_BITS), np.diff(self.offsets))
+        buckets = np.concatenate([old_buckets, buckets])
+        suffixes = np.concatenate([self.suffixes, suffixes])
+        # Sort by (bucket, suffix) and drop duplicates
+        keys = np.unique((buckets.astype(np.uint64) << np.uint64(32)) | suffixes)
+        buckets = (keys >> np.uint64(32)).astype(np.int64)
+        counts = np.bincount(buckets, minlength=1 << self.BUCKET_BITS)
+        offsets = np.zeros((1 << self.BUCKET_BITS) + 1, dtype=np.uint32)
+        np.cumsum(counts, out=offsets[1:])
+        self._set_table(offsets, (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32))
+        self._pending = []
+
+    def add_many(self, keys: Sequence[Union[str, bytes]]) -> None:
+        """Add a batch of keys; the table is rebuilt at the next lookup."""
+        if keys:
+            self._pending.append(self._hashes(keys))
+
+    def add(self, key: Union[str, bytes]) -> None:
+        """Add a single key to the set."""
+        self.add_many([key])
+
+    def contains_many(self, keys: Sequence[Union[str, bytes]]) -> np.ndarray:
+        """Return a boolean array telling which keys are in the set."""
+        self._merge_pending()
+        if not keys or not len(self.suffixes):
+            return np.zeros(len(keys), dtype=bool)
+        buckets, suffixes = self._split(self._hashes(keys))
+        # Compare on the full (bucket, suffix) key
+        table = self._table_keys()
+        wanted = (buckets.astype(np.uint64) << np.uint64(32)) | suffixes
+        idx = np.searchsorted(table, wanted)
+        idx[idx == len(table)] = 0
+        return table[idx] == wanted
+
+    def __contains__(self, key: Union[str, bytes]) -> bool:
+        self._merge_pending()
+        h = mmh3.hash64(key, signed=False)[0]
+        bucket = h >> (64 - self.BUCKET_BITS)
+        suffix = (h >> (32 - self.BUCKET_BITS)) & 0xFFFFFFFF
+        lo = self._offsets_view[bucket]
+        hi = self._offsets_view[bucket + 1]
+        i = bisect.bisect_left(self._suffixes_view, suffix, lo, hi)
+        return i < hi and self._suffixes_view[i] == suffix
+
+    def __len__(self) -> int:
+        self._merge_pending()
+        return len(self.suffixes)
+
+    @property
+    def nbytes(self) -> int:
+        self._merge_pending()
+        return self.offsets.nbytes + self.suffixes.nbytes
+
+    def save(self, path: Path) -> None:
+        """
+        Write the table as a small binary header followed by raw uint32 values.
+        
+        Args:
+            path: Base path; the '.bin' file is written next to it
+        """
+        self._merge_pending()
+        header = _HASH_SET_HEADER.pack(_HASH_SET_MAGIC, self.BUCKET_BITS, len(self.suffixes))
+        _write_blob(path.with_suffix('.bin'), header, self.offsets, self.suffixes)
+
+    @classmethod
+    def load(cls, path: Path) -> "HashSet":
+        """
+        Attach to a set written by save() by memory-mapping it read-only.
+        
+        Args:
+            path: Base path the set was saved under
+            
+        Returns:
+            A read-only HashSet
+        """
+        path = path.with_suffix('.bin')
+        bucket_bits, count = _read_header(path, _HASH_SET_HEADER, _HASH_SET_MAGIC)
+        if bucket_bits != cls.BUCKET_BITS:
+            raise ValueError(f"Unsupported hash set layout in {path}")
+        num_offsets = (1 << cls.BUCKET_BITS) + 1
+        table = np.memmap(path, dtype=np.uint32, mode='r', offset=_FILE_HEADER_SIZE,
+                          shape=(num_offsets + count,))
+        hash_set = cls.__new__(cls)
+        hash_set._set_table(table[:num_offsets], table[num_offsets:])
+        hash_set._pending = []
+        return hash_set
 
 class BlmFilter:
     """
@@ -16,20 +334,43 @@ class BlmFilter:
     Designed for resource-constrained environments like Raspberry Pi.
     """
     
-    BLOOM_FILTER_PATH = Path("/tmp/bloom_filter.pkl")
+    BLOOM_FILTER_PATH = Path("/tmp/bloom_filter")
+    HASH_SET_PATH = Path("/tmp/blocklist_hashes")
     LOG_FILE = Path("/tmp/bloom.log")
+    # Connections kept per session for blocklist downloads
+    HTTP_POOL_SIZE = 8
+    HTTP_TIMEOUT = 30  # seconds per download
+    # Distinct query names whose verdicts are remembered; DNS traffic is
+    # dominated by a small set of names, so most lookups hit the cache
+    VERDICT_CACHE_SIZE = 16384
     
-    def __init__(self, expected_entries: int = 600000, error_rate: float = 0.001):
+    def __init__(self, expected_entries: int = 600000, error_rate: float = 0.001,
+                 exact: bool = False, match_subdomains: bool = False):
         """
         Initialize the URL blocker with bloom filter parameters.
         
         Args:
             expected_entries: The expected number of URLs to be loaded
             error_rate: Acceptable false positive rate (0.001 = 0.1%)
+            exact: Use a sorted HashSet instead of the bloom filter, trading
+                ~2.5x the memory for no false positives
+            match_subdomains: Also block DNS queries for subdomains of
+                listed domains. Entries lose their "www." when loaded, so
+                a listed www.example.com covers all of example.com, and
+                each parent domain probed is another chance of a bloom
+                filter false positive
         """
         self.expected_entries = expected_entries
         self.error_rate = error_rate
+        self.exact = exact
+        self.match_subdomains = match_subdomains
+        self.filter_path = self.HASH_SET_PATH if exact else self.BLOOM_FILTER_PATH
         self.bloom_filter = None
+        # TLDs of all listed entries; a name under any other TLD can't be
+        # listed, which one set probe settles. None when unknown.
+        self.tlds: Optional[frozenset] = None
+        self._check_qname_cached = functools.lru_cache(
+            maxsize=self.VERDICT_CACHE_SIZE)(self._check_qname)
         self.setup_logging()
         
     def setup_logging(self) -> None:
@@ -50,9 +391,11 @@ class BlmFilter:
             # Create a logger specifically for this class
             self.logger = logging.getLogger('BloomFilter')
             
-            # Clear any existing handlers to avoid duplicates
-            if self.logger.handlers:
-                self.logger.handlers.clear()
+            # Clear any existing handlers to avoid duplicates, flushing
+            # anything they still buffer
+            for handler in self.logger.handlers:
+                handler.close()
+            self.logger.handlers.clear()
             
             # Set the level for this logger
             self.logger.setLevel(logging.INFO)
@@ -60,10 +403,14 @@ class BlmFilter:
             # Create formatter
             formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
             
-            # Add file handler
+            # Add file handler, buffered so records are written in chunks
+            # (errors are written out immediately)
             file_handler = logging.FileHandler(self.LOG_FILE, mode='a')
             file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
+            self.log_buffer = logging.handlers.MemoryHandler(
+                capacity=1024, flushLevel=logging.ERROR, target=file_handler
+            )
+            self.logger.addHandler(self.log_buffer)
             
             # Set propagate to False to prevent messages from propagating to the root logger
             self.logger.propagate = False
@@ -71,9 +418,45 @@ class BlmFilter:
             self.logger.info("BloomFilter logging initialized")
         except Exception as e:
             print(f"Error setting up logging: {e}")
+    
+    def flush_logs(self) -> None:
+        """Write out any buffered log records."""
+        for handler in self.logger.handlers:
+            handler.flush()
             
 
     
+    def http_session(self) -> aiohttp.ClientSession:
+        """
+        Create an HTTP session for blocklist downloads.
+        
+        Downloads made through one session reuse its connections and cache
+        DNS lookups, so several lists from the same host skip the repeated
+        handshakes.
+        """
+        return aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.HTTP_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=self.HTTP_POOL_SIZE, ttl_dns_cache=300),
+        )
+    
+    async def download(self, url: str, session: Optional[aiohttp.ClientSession] = None) -> bytes:
+        """
+        Fetch a list whole; it is a few MB at most.
+        
+        Args:
+            url: URL of the list to download
+            session: Session to use, or None to open one for this download
+            
+        Returns:
+            The response body
+        """
+        if session is None:
+            async with self.http_session() as session:
+                return await self.download(url, session)
+        async with session.get(url) as response:
+            response.raise_for_status()  # Raise exception for HTTP errors
+            return await response.read()
+    
     def normalize_url(self, url: str) -> str:
         """
         Normalize a URL to ensure consistent format for checking.
@@ -84,29 +467,32 @@ class BlmFilter:
         Returns:
             Normalized URL string
         """
-        # Remove protocol, 'www.', trailing slashes, and convert to lowercase
-        url = url.lower().strip()
+        # Remove protocol, path, 'www.' and trailing dots, and convert to lowercase
+        url = url.strip().lower()
         
-        # Handle common URL formats
-        if '://' in url:
-            parsed = urlparse(url)
-            url = parsed.netloc
+        # Keep only the host part of full URLs
+        scheme_end = url.find('://')
+        if scheme_end >= 0:
+            url = url[scheme_end + 3:]
+        path_start = url.find('/')
+        if path_start >= 0:
+            url = url[:path_start]
         
         # Remove 'www.' prefix if present
         if url.startswith('www.'):
             url = url[4:]
             
-        # Remove trailing slashes and whitespace
-        url = url.rstrip('/')
-        
-        return url
+        # Remove the trailing dot of fully qualified names
+        return url.rstrip('.')
     
-    def load_urls_from_url(self, url: str) -> Tuple[bool, str]:
+    async def load_urls_from_url(self, url: str,
+                                 session: Optional[aiohttp.ClientSession] = None) -> Tuple[bool, str]:
         """
         Load URLs from a remote URL into a Bloom filter.
         
         Args:
             url: URL of the list to download
+            session: HTTP session to download with, or None for a new one
             
         Returns:
             Tuple of (success, message)
@@ -115,59 +501,55 @@ class BlmFilter:
         start_time = time.time()
         
         # Create a new Bloom filter
-        bloom = BloomFilter(capacity=self.expected_entries, error_rate=self.error_rate)
+        if self.exact:
+            bloom = HashSet()
+        else:
+            bloom = BloomFilter(capacity=self.expected_entries, error_rate=self.error_rate)
         
         try:
-            # Stream the file to process it line by line
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()  # Raise exception for HTTP errors
+            # Fetch the list whole and let the regex engine do the per-line
+            # work
+            body = await self.download(url, session)
             
+            # Lowercase the whole body in one go; the regex does the rest of
+            # the normalization, so no Python code runs per entry
+            entries = _HOST_ENTRY.findall(body.lower())
+            
+            # Insert in batches so hashing and bit setting are vectorized
             count = 0
-            for line in response.iter_lines():
-                if line:
-                    # Convert bytes to string and strip whitespace
-                    url_entry = line.decode('utf-8', errors='ignore').strip()
-                    
-                    # Skip comment lines and empty lines
-                    if not url_entry or url_entry.startswith('#'):
-                        continue
-                    
-                    # Handle different formats of blocklist entries
-                    # Format: "0.0.0.0 domain.com" or "127.0.0.1 domain.com"
-                    if re.match(r'^\d+\.\d+\.\d+\.\d+\s+', url_entry):
-                        url_entry = url_entry.split()[1]
-                    # Format: "domain.com"
-                    elif ' ' in url_entry:
-                        url_entry = url_entry.split()[0]
-                    
-                    # Normalize the URL before adding to the filter
-                    normalized_url = self.normalize_url(url_entry)
-                    if normalized_url:  # Only add non-empty URLs
-                        bloom.add(normalized_url)
-                        count += 1
-                    
-                    # Log progress periodically
-                    if count % 50000 == 0:
-                        self.logger.info(f"Processed {count} entries...")
+            for start in range(0, len(entries), bloom.BATCH_SIZE):
+                batch = entries[start:start + bloom.BATCH_SIZE]
+                bloom.add_many(batch)
+                count += len(batch)
+                
+                # Log progress periodically
+                if count % 50000 == 0:
+                    self.logger.info(f"Processed {count} entries...")
             
             elapsed_time = time.time() - start_time
-            memory_usage = bloom.bitarray.nbytes / (1024*1024)
+            memory_usage = bloom.nbytes / (1024*1024)
             
             self.logger.info(f"Loaded {count} URLs in {elapsed_time:.2f} seconds")
             self.logger.info(f"Bloom filter memory usage: {memory_usage:.2f} MB")
             
             # Save sample entries for debugging
             if count > 0:
-                self.logger.info(f"Sample entry format: {normalized_url}")
+                self.logger.info(f"Sample entry format: {entries[-1].decode(errors='replace')}")
             
             self.bloom_filter = bloom
+            self.tlds = frozenset(entry.rpartition(b'.')[2] for entry in entries)
+            self._check_qname_cached.cache_clear()
             
-            # Save to disk for later loading
-            self._save_bloom_filter()
+            # Save to disk for later loading, then swap the freshly built
+            # arrays for a read-only map of the saved file: nothing can
+            # write to the filter any more, and forked workers share the
+            # page cache instead of private heap pages
+            if self._save_bloom_filter():
+                self.bloom_filter = type(bloom).load(self.filter_path)
             
             return True, f"Successfully loaded {count} URLs"
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             error_msg = f"Error downloading URL list: {str(e)}"
             self.logger.error(error_msg)
             return False, error_msg
@@ -175,13 +557,20 @@ class BlmFilter:
             error_msg = f"Unexpected error loading URLs: {str(e)}"
             self.logger.error(error_msg)
             return False, error_msg
+        finally:
+            self.flush_logs()
     
     def _save_bloom_filter(self) -> bool:
         """Save the bloom filter to disk."""
         try:
-            with open(self.BLOOM_FILTER_PATH, 'wb') as f:
-                pickle.dump(self.bloom_filter, f)
-            self.logger.info(f"Saved bloom filter to {self.BLOOM_FILTER_PATH}")
+            # Drop the old TLDs before replacing the filter and write the new
+            # ones after it, so a failure anywhere leaves either no TLDs
+            # (treated as unknown) or the ones that match the saved filter
+            tlds_path = self.filter_path.with_suffix('.tlds')
+            tlds_path.unlink(missing_ok=True)
+            self.bloom_filter.save(self.filter_path)
+            _write_tlds(tlds_path, self.tlds)
+            self.logger.info(f"Saved bloom filter to {self.filter_path}")
             return True
         except Exception as e:
             self.logger.error(f"Failed to save bloom filter: {str(e)}")
@@ -190,10 +579,12 @@ class BlmFilter:
     def load_bloom_filter(self) -> bool:
         """Load the bloom filter from disk if available."""
         try:
-            if self.BLOOM_FILTER_PATH.exists():
-                with open(self.BLOOM_FILTER_PATH, 'rb') as f:
-                    self.bloom_filter = pickle.load(f)
-                self.logger.info(f"Loaded bloom filter from {self.BLOOM_FILTER_PATH}")
+            if self.filter_path.with_suffix('.bin').exists():
+                filter_class = HashSet if self.exact else BloomFilter
+                self.bloom_filter = filter_class.load(self.filter_path)
+                self.tlds = _read_tlds(self.filter_path.with_suffix('.tlds'))
+                self._check_qname_cached.cache_clear()
+                self.logger.info(f"Loaded bloom filter from {self.filter_path}")
                 self.logger.info(f"Bloom filter contains ~{len(self.bloom_filter)} URLs")
                 return True
             else:
@@ -202,6 +593,8 @@ class BlmFilter:
         except Exception as e:
             self.logger.error(f"Failed to load bloom filter: {str(e)}")
             return False
+        finally:
+            self.flush_logs()
     
     def check_url(self, url: str) -> bool:
         """
@@ -216,12 +609,55 @@ class BlmFilter:
         if self.bloom_filter is None:
             self.logger.error("Bloom filter not initialized. Please load URLs first.")
             return False
-        if url.endswith('.'):
-            url = url[:-1]
         # Normalize the URL before checking
         normalized_url = self.normalize_url(url)
         return normalized_url in self.bloom_filter
     
+    def check_dns_qname(self, qname: bytes) -> bool:
+        """
+        Check a DNS query name against the bloom filter.
+        
+        Query names are bare hostnames, so this skips the URL handling of
+        normalize_url and works on the raw label bytes. With
+        match_subdomains, each parent domain is checked as well, which costs
+        one lookup per label regardless of the blocklist size.
+        
+        Args:
+            qname: The query name, with or without the trailing dot
+            
+        Returns:
+            True if the name is in the filter, False otherwise
+        """
+        if self.bloom_filter is None:
+            self.logger.error("Bloom filter not initialized. Please load URLs first.")
+            return False
+        return self._check_qname_cached(qname)
+    
+    def _check_qname(self, qname: bytes) -> bool:
+        """Uncached lookup behind check_dns_qname."""
+        if qname.endswith(b'.'):
+            qname = qname[:-1]
+        qname = qname.lower()
+        if qname.startswith(b'www.'):
+            qname = qname[4:]
+        # Every suffix shares the TLD, so this rules out the whole walk
+        if self.tlds is not None and qname[qname.rfind(b'.') + 1:] not in self.tlds:
+            return False
+        contains = self.bloom_filter.__contains__
+        if contains(qname):
+            return True
+        if not self.match_subdomains:
+            return False
+        # Walk up one label at a time, as in a reverse-label trie, stopping
+        # before the bare TLD; each step is one C-level find and one probe
+        last_dot = qname.rfind(b'.')
+        dot = qname.find(b'.')
+        while dot < last_dot:
+            if contains(qname[dot + 1:]):
+                return True
+            dot = qname.find(b'.', dot + 1)
+        return False
+    
     def batch_check_urls(self, urls: List[str]) -> List[Tuple[str, bool]]:
         """
         Check multiple URLs against the bloom filter.
@@ -236,7 +672,10 @@ class BlmFilter:
             self.logger.error("Bloom filter not initialized. Please load URLs first.")
             return [(url, False) for url in urls]
         
-        return [(url, self.check_url(url)) for url in urls]
+        # Normalize everything first, then test all keys in one vectorized pass
+        normalized_urls = [self.normalize_url(url) for url in urls]
+        hits = self.bloom_filter.contains_many(normalized_urls)
+        return list(zip(urls, hits.tolist()))
     
     def debug_check(self, url: str) -> None:
         """
@@ -259,27 +698,31 @@ class BlmFilter:
         self.logger.info(f"  In bloom filter: {result}")
         self.logger.info(f"  Bloom filter size: ~{len(self.bloom_filter)} entries")
         self.logger.info(f"  False positive rate: {self.bloom_filter.error_rate}")
+        self.flush_logs()
 
 # Example of how to use this at boot time
-def initialize_bloom(blocklist_url: str) -> Optional[BlmFilter]:
+async def initialize_bloom(blocklist_url: str, exact: bool = False,
+                           match_subdomains: bool = False) -> Optional[BlmFilter]:
     """
     Initialize the URL blocker at boot time.
     
     Args:
         blocklist_url: URL to download the blocklist from
+        exact: Use the exact HashSet instead of a bloom filter
+        match_subdomains: Also block subdomains of listed domains
         
     Returns:
         URLBlocker instance or None if initialization failed
     """
     try:
-        blocker = BlmFilter()
+        blocker = BlmFilter(exact=exact, match_subdomains=match_subdomains)
         blocker.setup_logging()
         # Try to load existing bloom filter first
         if blocker.load_bloom_filter():
             return blocker
         
         # If loading failed, download and create a new one
-        success, message = blocker.load_urls_from_url(blocklist_url)
+        success, message = await blocker.load_urls_from_url(blocklist_url)
         if success:
             return blocker
         else:
@@ -297,7 +740,7 @@ if __name__ == "__main__":
     blocklist_url = "https://raw.githubusercontent.com/hagezi/dns-blocklists/main/hosts/pro.txt"
     
     # Initialize blocker
-    blocker = initialize_bloom(blocklist_url)
+    blocker = asyncio.run(initialize_bloom(blocklist_url))
     
     if blocker:
         # Example of checking URLs
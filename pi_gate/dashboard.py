@@ -1,8 +1,11 @@
 import dash
 from dash import dcc, html
+from dash.exceptions import PreventUpdate
 import logging
 import asyncio
-from .database import fetch_logs
+import threading
+from typing import Optional
+from .database import fetch_logs, latest_log_id
 
 LOG_FILE = "/tmp/pi_gate.log"
 logging.basicConfig(
@@ -12,26 +15,52 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+# Only the most recent rows are rendered on each refresh
+MAX_ROWS = 500
+
+# Database calls run on one long-lived loop so the read connection
+# opened on it is reused across refreshes; started by start_dashboard()
+_db_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def run_db(coro):
+    """Run a database coroutine on the dashboard's loop and wait for it."""
+    return asyncio.run_coroutine_threadsafe(coro, _db_loop).result()
+
 app = dash.Dash(__name__)
 
 app.layout = html.Div([
     html.H1("DNS Logs Dashboard"),
-    dcc.Interval(id="interval-component", interval=5000, n_intervals=0),  # Refresh every 5s
+    dcc.Interval(id="interval-component", interval=5000, n_intervals=0),  # Check every 5s
+    dcc.Store(id="last-log-id"),  # Newest row currently rendered
     html.Div(id="table-content")
 ])
 
+async def fetch_new_logs(last_id):
+    """Return (latest_id, logs), with logs None if nothing was logged since last_id."""
+    latest_id = await latest_log_id()
+    if last_id is not None and latest_id == last_id:
+        return latest_id, None
+    return latest_id, await fetch_logs(limit=MAX_ROWS)
+
 @app.callback(
-    dash.Output("table-content", "children"),
-    [dash.Input("interval-component", "n_intervals")]
+    [dash.Output("table-content", "children"), dash.Output("last-log-id", "data")],
+    [dash.Input("interval-component", "n_intervals")],
+    [dash.State("last-log-id", "data")]
 )
-def update_table(n):
+def update_table(n, last_id):
     try:
-        logs = asyncio.run(fetch_logs())
-        return [html.P(f"{log}") for log in logs]
+        latest_id, logs = run_db(fetch_new_logs(last_id))
     except Exception as e:
         logging.error(f"Error updating table: {e}")
-        return [html.P("Error loading logs.")]
+        return [html.P("Error loading logs.")], None
+    # Skip the query and re-render entirely while no new rows arrive
+    if logs is None:
+        raise PreventUpdate
+    return [html.P(f"{log}") for log in logs], latest_id
 
 def start_dashboard():
+    global _db_loop
     logging.info("Starting dashboard...")
+    _db_loop = asyncio.new_event_loop()
+    threading.Thread(target=_db_loop.run_forever, daemon=True).start()
     app.run_server(debug=False, host="0.0.0.0", port=8050)
\ No newline at end of file
@@ -1,8 +1,10 @@
 import aiosqlite
 import logging
-import pandas as pd
 import asyncio
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 LOG_FILE = "/tmp/pi_gate.log"
 logging.basicConfig(
@@ -14,27 +16,138 @@ logging.basicConfig(
 
 DATABASE_FILE = "dns_logs.db"
 
+# Query log rows are buffered and written in batches
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.2  # seconds
+# Rows buffered at most; beyond that new rows are dropped rather than
+# slowing down DNS answers
+LOG_QUEUE_SIZE = 10000
+
+# Long-lived connection and write queue, set up by init_db()
+_db: Optional[aiosqlite.Connection] = None
+_queue: Optional[asyncio.Queue] = None
+_flusher_task: Optional[asyncio.Task] = None
+# Set by close_db() so the flusher stops waiting for a batch to fill up
+_stopping: Optional[asyncio.Event] = None
+# Rows dropped because the queue was full, since last reported
+_dropped = 0
+
+# Long-lived read connection, opened on first use by _get_reader()
+_reader: Optional[aiosqlite.Connection] = None
+
 async def init_db() -> None:
-    """Initialize the database and create tables if they don't exist."""
+    """Open the shared database connection and create tables if they don't exist."""
+    global _db, _queue, _flusher_task, _stopping
     try:
-        async with aiosqlite.connect(DATABASE_FILE) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS dns_requests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    client_ip TEXT,
-                    domain TEXT,
-                    blocked INTEGER,
-                    success INTEGER,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            await db.commit()
+        if _db is None:
+            _db = await aiosqlite.connect(DATABASE_FILE)
+            await _db.execute("PRAGMA journal_mode=WAL")
+            await _db.execute("PRAGMA synchronous=NORMAL")
+            await _db.execute("PRAGMA temp_store=MEMORY")
+        await _db.execute("""
+            CREATE TABLE IF NOT EXISTS dns_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_ip TEXT,
+                domain TEXT,
+                blocked INTEGER,
+                success INTEGER,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # fetch_logs orders by newest first
+        await _db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_dns_ts ON dns_requests (timestamp DESC)"
+        )
+        await _db.commit()
     except aiosqlite.Error as e:
         logging.error(f"Error initializing database: {e}")
         raise
 
+    if _flusher_task is None:
+        _queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        _stopping = asyncio.Event()
+        _flusher_task = asyncio.create_task(_flusher(_queue, _stopping))
+
+async def _get_reader() -> aiosqlite.Connection:
+    """Return the shared read connection, opening it on first use.
+
+    The connection is bound to the event loop that opened it, so callers
+    must keep using a single loop.
+    """
+    global _reader
+    if _reader is None:
+        _reader = await aiosqlite.connect(DATABASE_FILE)
+        _reader.row_factory = aiosqlite.Row
+    return _reader
+
+async def close_db() -> None:
+    """Flush any buffered query logs and close the shared connections."""
+    global _db, _queue, _flusher_task, _stopping, _reader
+    if _flusher_task is not None:
+        # Detach the queue first so rows logged from here on are ignored
+        # rather than queued behind the stop sentinel
+        queue, _queue = _queue, None
+        # Queue the stop sentinel and let the flusher write everything ahead of it
+        await queue.put(None)
+        _stopping.set()
+        await _flusher_task
+        _flusher_task = _stopping = None
+
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+    if _reader is not None:
+        await _reader.close()
+        _reader = None
+
+async def _write_batch(batch: List[Tuple[str, str, int, int]]) -> None:
+    """Insert a batch of query log rows in a single transaction."""
+    try:
+        await _db.executemany(
+            "INSERT INTO dns_requests (client_ip, domain, blocked, success) VALUES (?, ?, ?, ?)",
+            batch
+        )
+        await _db.commit()
+    except aiosqlite.Error as e:
+        logging.error(f"Error logging {len(batch)} queries: {e}")
+
+async def _flusher(queue: asyncio.Queue, stopping: asyncio.Event) -> None:
+    """Drain the query log queue, committing up to FLUSH_BATCH_SIZE rows at a time.
+
+    Returns once the None sentinel queued by close_db() is reached, without
+    waiting out FLUSH_INTERVAL once close_db() has set stopping.
+    """
+    while True:
+        batch = [await queue.get()]
+        # Give a partial batch a moment to fill up before committing
+        if queue.qsize() < FLUSH_BATCH_SIZE - 1:
+            try:
+                await asyncio.wait_for(stopping.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        while len(batch) < FLUSH_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        stopping = None in batch
+        if stopping:
+            batch = [row for row in batch if row is not None]
+        if batch:
+            await _write_batch(batch)
+        _report_dropped()
+        if stopping:
+            return
+
+def _report_dropped() -> None:
+    """Log how many rows were dropped since the last call, if any."""
+    global _dropped
+    if _dropped:
+        logging.warning(f"Dropped {_dropped} query log rows: queue full")
+        _dropped = 0
+
 async def log_query(client_ip: str, domain: str, blocked: int, success: int) -> None:
-    """Log a DNS query to the database.
+    """Queue a DNS query to be logged to the database.
+    
+    Never waits: if the queue is full the row is dropped and counted.
     
     Args:
         client_ip: The IP address of the client making the request
@@ -42,16 +155,21 @@ async def log_query(client_ip: str, domain: str, blocked: int, success: int) ->
         blocked: 1 if the request was blocked, 0 if allowed
         success: 1 if resolved successfully, 0 if failed
     """
+    log_query_nowait(client_ip, domain, blocked, success)
+
+def log_query_nowait(client_ip: str, domain: str, blocked: int, success: int) -> None:
+    """Queue a DNS query to be logged, for callers that are not coroutines.
+
+    Takes the same arguments as log_query(). Rows logged while the
+    database is not open are ignored.
+    """
+    global _dropped
+    if _queue is None:
+        return
     try:
-        async with aiosqlite.connect(DATABASE_FILE) as db:
-            await db.execute(
-                "INSERT INTO dns_requests (client_ip, domain, blocked, success) VALUES (?, ?, ?, ?)",
-                (client_ip, domain, blocked, success)
-            )
-            await db.commit()
-    except aiosqlite.Error as e:
-        logging.error(f"Error logging query: {e}")
-        raise
+        _queue.put_nowait((client_ip, domain, blocked, success))
+    except asyncio.QueueFull:
+        _dropped += 1
 
 async def fetch_logs(limit: Optional[int] = None, 
                     offset: int = 0,
@@ -89,22 +207,34 @@ async def fetch_logs(limit: Optional[int] = None,
             query += f" LIMIT ? OFFSET ?"
             params.extend([limit, offset])
         
-        async with aiosqlite.connect(DATABASE_FILE) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute(query, params)
-            rows = await cursor.fetchall()
-            
-            # Convert to list of dictionaries
-            result = [dict(row) for row in rows]
-            return result
+        db = await _get_reader()
+        cursor = await db.execute(query, params)
+        rows = await cursor.fetchall()
+        
+        # Convert to list of dictionaries
+        result = [dict(row) for row in rows]
+        return result
             
     except aiosqlite.Error as e:
         logging.error(f"Error fetching logs: {e}")
         return []
 
+async def latest_log_id() -> Optional[int]:
+    """Return the id of the most recently logged query, or None if there are none."""
+    try:
+        db = await _get_reader()
+        cursor = await db.execute("SELECT MAX(id) FROM dns_requests")
+        row = await cursor.fetchone()
+        return row[0]
+    except aiosqlite.Error as e:
+        logging.error(f"Error fetching latest log id: {e}")
+        return None
+
 # Helper function for pandas DataFrame conversion (runs in a separate thread)
-async def get_logs_dataframe() -> pd.DataFrame:
+async def get_logs_dataframe() -> "pd.DataFrame":
     """Fetch all logs and return as a pandas DataFrame."""
+    # pandas is heavy to import, so only load it when a DataFrame is wanted
+    import pandas as pd
     try:
         logs = await fetch_logs()
         # Run DataFrame conversion in a thread pool to avoid blocking
@@ -1,25 +1,69 @@
 #!/usr/bin/env python3
 import asyncio
 import os
+import random
+import signal
+import socket
+import struct
+import sys
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
 import aiohttp
-import uvloop
 import logging
-from dnslib import DNSRecord, DNSHeader, RR, A, QTYPE
-from .database import log_query
+from dnslib import DNSRecord
+from .database import init_db, close_db, log_query_nowait
 from .blm_filter import initialize_bloom
+from . import mmsg
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on every platform
+    uvloop = None
 
 
 blocklist_url = "https://raw.githubusercontent.com/hagezi/dns-blocklists/main/hosts/pro.txt"
 
 SINKHOLE_IP = "0.0.0.0"
 
+# Block subdomains of listed domains too (e.g. ads.example.com when
+# example.com is listed). Off by default: entries are stored without their
+# "www.", so a listed www.example.com would then block every subdomain of
+# example.com, and with the bloom filter each extra label checked adds
+# another chance of a false positive (~0.1% per label instead of per name)
+BLOCK_SUBDOMAINS = False
+# Use an exact hash set instead of the bloom filter (no false positives,
+# ~2.5x the memory)
+EXACT_BLOCKLIST = False
+
 UPSTREAM_DNS = ("8.8.8.8", 53)
 
 LISTEN_HOST = "0.0.0.0"
 LISTEN_PORT = 53
 
+# Worker processes sharing LISTEN_PORT through SO_REUSEPORT
+DNS_WORKERS = os.cpu_count() or 1
+
+# Datagrams drained from the listening socket per readiness wakeup
+RECV_BATCH = 32
+# Largest query accepted over UDP, EDNS0 payloads included
+MAX_DNS_PACKET = 4096
+
+# Reply header flags: QR, AA and RA for blocked names; QR, RA and
+# RCODE=SERVFAIL when the upstream server does not answer
+BLOCKED_FLAGS = 0x8480
+SERVFAIL_FLAGS = 0x8082
+# The RD bit is echoed back from the query
+RD_FLAG = 0x0100
+
+# Answer record for blocked names: a pointer to the question name, type A,
+# class IN, TTL 60 and SINKHOLE_IP as rdata
+SINKHOLE_ANSWER = b"\xc0\x0c\x00\x01\x00\x01" + struct.pack(">IH", 60, 4) + socket.inet_aton(SINKHOLE_IP)
+
+# Upstream replies kept for repeat queries, and the longest any is kept
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_CACHE_MAX_TTL = 3600  # seconds
+
 # Global variable to hold the bloom filter
 BLOOM = None
 # -------------------------------
@@ -31,95 +75,392 @@ LOG_FILE = "/tmp/dns_sinkhole.log"
 # Asynchronous Upstream Query
 # -------------------------------
 
-class DnsClientProtocol(asyncio.DatagramProtocol):
-    def __init__(self, request_data, loop):
-        self.request_data = request_data
-        self.loop = loop
-        self.on_response = loop.create_future()
+class UpstreamClient(asyncio.DatagramProtocol):
+    """One long-lived UDP socket to UPSTREAM_DNS shared by all forwarded queries.
+
+    Each query is sent under a fresh, random transaction ID so concurrent
+    clients can never collide; the client's own ID is put back on the
+    response before it is returned. The source port never changes, so a
+    reply is only accepted if it also echoes the query's question
+    (RFC 5452); anything else is dropped as a possible spoof.
+    """
+
+    def __init__(self):
+        self.transport = None
+        # upstream txid -> (future for the response, client's txid, question)
+        self.pending: Dict[int, Tuple[asyncio.Future, bytes, bytes]] = {}
 
     def connection_made(self, transport):
         self.transport = transport
-        self.transport.sendto(self.request_data)
+
+    def query(self, data: bytes, question: bytes) -> asyncio.Future:
+        """Send data upstream and return a future for the response.
+
+        question is the raw question section of data.
+        """
+        txid = random.getrandbits(16)
+        while txid in self.pending:
+            txid = random.getrandbits(16)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[txid] = (future, data[:2], question)
+        # Forget the query once answered, timed out or cancelled
+        future.add_done_callback(lambda f: self.forget(txid, f))
+        self.transport.sendto(struct.pack(">H", txid) + data[2:])
+        return future
+
+    def forget(self, txid: int, future: asyncio.Future) -> None:
+        """Drop the pending entry for txid if it still belongs to future.
+
+        An answered query's txid is free for reuse before this runs, so the
+        entry may already be a newer query's.
+        """
+        entry = self.pending.get(txid)
+        if entry is not None and entry[0] is future:
+            del self.pending[txid]
 
     def datagram_received(self, data, addr):
-        if not self.on_response.done():
-            self.on_response.set_result(data)
+        if len(data) < 12:
+            return
+        txid = int.from_bytes(data[:2], "big")
+        entry = self.pending.get(txid)
+        if entry is None:
+            return  # late reply to a query that already timed out
+        future, client_txid, question = entry
+        echoed = data[12:12 + len(question)]
+        # Names compare case-insensitively, QTYPE and QCLASS exactly
+        if (data[4:6] != b"\x00\x01" or echoed[:-4].lower() != question[:-4].lower()
+                or echoed[-4:] != question[-4:]):
+            logging.warning(f"Dropped upstream reply with mismatched question (txid {txid})")
+            return
+        del self.pending[txid]
+        if not future.done():
+            future.set_result(client_txid + data[2:])
 
     def error_received(self, exc):
-        if not self.on_response.done():
-            self.on_response.set_exception(exc)
+        # ICMP errors can't be tied to a query; those queries simply time out
+        logging.warning(f"Upstream DNS socket error: {exc}")
 
     def connection_lost(self, exc):
-        if not self.on_response.done():
-            self.on_response.set_exception(exc or Exception("Connection lost"))
+        for future, _, _ in list(self.pending.values()):
+            if not future.done():
+                future.set_exception(exc or ConnectionError("Upstream socket closed"))
+        self.pending.clear()
 
 
-async def forward_query(data):
-    loop = asyncio.get_running_loop()
+# Upstream client of this worker, created by start_dns_server()
+UPSTREAM: Optional[UpstreamClient] = None
+
+
+def response_ttl(response: bytes) -> int:
+    """Return how many seconds an upstream reply may be cached, 0 if it may not."""
     try:
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: DnsClientProtocol(data, loop),
-            remote_addr=UPSTREAM_DNS
-        )
-        try:
-            response = await asyncio.wait_for(protocol.on_response, timeout=2)
-            return response
-        except asyncio.TimeoutError:
-            logging.warning("Timeout while forwarding query to upstream DNS.")
+        record = DNSRecord.parse(response)
+    except Exception:
+        return 0
+    # Only complete NOERROR and NXDOMAIN answers are worth repeating
+    if record.header.tc or record.header.rcode not in (0, 3):
+        return 0
+    ttls = [rr.ttl for rr in record.rr + record.auth]
+    return min(min(ttls), RESPONSE_CACHE_MAX_TTL) if ttls else 0
+
+
+def skip_name(data: bytes, pos: int) -> int:
+    """Return the offset just past the possibly compressed name at pos."""
+    while True:
+        length = data[pos]
+        if length == 0:
+            return pos + 1
+        if length >= 0xC0:  # compression pointer ends the name
+            return pos + 2
+        pos += 1 + length
+
+
+def ttl_offsets(response: bytes) -> Optional[List[int]]:
+    """Return where the TTL of each record in response is, None if it is malformed.
+
+    The OPT pseudo-record is skipped, its TTL field holds EDNS flags.
+    """
+    try:
+        qdcount, ancount, nscount, arcount = struct.unpack_from(">HHHH", response, 4)
+        pos = 12
+        for _ in range(qdcount):
+            pos = skip_name(response, pos) + 4
+        offsets = []
+        for _ in range(ancount + nscount + arcount):
+            pos = skip_name(response, pos)
+            rtype, _, _, rdlength = struct.unpack_from(">HHIH", response, pos)
+            if rtype != 41:
+                offsets.append(pos + 4)
+            pos += 10 + rdlength
+    except (IndexError, struct.error):
+        return None
+    return offsets if pos <= len(response) else None
+
+
+def cache_key(data: bytes, question: bytes) -> Optional[bytes]:
+    """Return the key a query's reply is cached under, None if it must not be cached.
+
+    Replies to EDNS queries carry an OPT record, and DNSSEC records too when
+    the DO bit is set, while the RD and CD flags change what upstream looks
+    up and whether it validates. So the raw question section is extended
+    with the RD and CD flags, whether the query had an OPT record and its DO
+    bit. Queries with any other additional records are not cached.
+    """
+    flags = bytes((data[2] & 0x01, data[3] & 0x10))  # RD, CD
+    if data[10:12] == b"\x00\x00":
+        return question + flags + b"\x00"
+    end = 12 + len(question)
+    # Only a lone OPT record for the root name right after the question
+    if (data[6:12] != b"\x00\x00\x00\x00\x00\x01" or len(data) < end + 11
+            or data[end:end + 3] != b"\x00\x00\x29"):
+        return None
+    dnssec_ok = data[end + 7] & 0x80
+    return question + flags + (b"\x02" if dnssec_ok else b"\x01")
+
+
+class ResponseCache:
+    """LRU cache of upstream replies keyed by cache_key().
+
+    Each reply expires after the smallest TTL among its records, and the
+    TTLs it is served with count down by the time it has been cached, so
+    clients never keep a record longer than upstream allowed.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # key -> (time cached and expiry on the monotonic clock, reply, TTL offsets)
+        self.entries: "OrderedDict[bytes, Tuple[float, float, bytes, List[int]]]" = OrderedDict()
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        cached_at, expiry, response, offsets = entry
+        now = time.monotonic()
+        if expiry <= now:
+            del self.entries[key]
             return None
-        finally:
-            transport.close()
+        self.entries.move_to_end(key)
+        age = int(now - cached_at)
+        if not age:
+            return response
+        reply = bytearray(response)
+        for pos in offsets:
+            ttl, = struct.unpack_from(">I", reply, pos)
+            struct.pack_into(">I", reply, pos, max(ttl - age, 0))
+        return bytes(reply)
+
+    def put(self, key: bytes, response: bytes) -> None:
+        ttl = response_ttl(response)
+        if not ttl:
+            return
+        offsets = ttl_offsets(response)
+        if offsets is None:
+            return
+        now = time.monotonic()
+        self.entries[key] = (now, now + ttl, response, offsets)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE)
+
+
+async def forward_query(data, question):
+    try:
+        return await asyncio.wait_for(UPSTREAM.query(data, question), timeout=2)
+    except asyncio.TimeoutError:
+        logging.warning("Timeout while forwarding query to upstream DNS.")
+        return None
     except Exception as e:
         logging.error(f"Error forwarding query: {e}")
         return None
 
 
 # -------------------------------
-# Asyncio DNS Server Protocol
+# DNS Wire Format
 # -------------------------------
 
-class DnsServerProtocol(asyncio.DatagramProtocol):
-    def connection_made(self, transport):
-        self.transport = transport
+def parse_question(data: bytes) -> Optional[Tuple[bytes, bytes]]:
+    """Read the question of a standard single-question query straight from the packet.
+
+    Returns (qname, question) where qname is the dotted name without the
+    trailing dot and question is the raw question section, or None if the
+    packet is anything other than a plain query.
+    """
+    if len(data) < 17:
+        return None
+    flags, qdcount = struct.unpack_from(">HH", data, 2)
+    # Responses and opcodes other than QUERY are left to dnslib
+    if flags & 0xF800 or qdcount != 1:
+        return None
+    labels = []
+    pos = 12
+    while pos < len(data):
+        length = data[pos]
+        if length == 0:
+            end = pos + 5  # terminating zero, QTYPE and QCLASS
+            if end > len(data):
+                return None
+            return b".".join(labels), data[12:end]
+        if length > 63:  # compression pointer, not expected in a question
+            return None
+        labels.append(data[pos + 1:pos + 1 + length])
+        pos += 1 + length
+    return None
+
+def read_question(data: bytes) -> Tuple[bytes, bytes]:
+    """Like parse_question(), falling back to a full dnslib parse for unusual packets."""
+    question = parse_question(data)
+    if question is not None:
+        return question
+    request = DNSRecord.parse(data)
+    return b".".join(request.q.qname.label), bytes(DNSRecord(q=request.q).pack()[12:])
+
+def build_reply(data: bytes, question: bytes, flags: int, answer: bytes = b"") -> bytes:
+    """Build a reply to query data echoing its question, with at most one answer record."""
+    header = struct.pack(">2sHHHHH", data[:2], flags | (data[2] << 8 & RD_FLAG),
+                         1, 1 if answer else 0, 0, 0)
+    return header + question + answer
+
+
+# -------------------------------
+# Asyncio DNS Server
+# -------------------------------
+
+class DnsServer:
+    """Serves queries read straight off the listening socket.
+
+    Whenever the socket becomes readable, up to RECV_BATCH queued datagrams
+    are drained at once, so a burst of queries costs a single event loop
+    wakeup instead of one per packet. Where recvmmsg/sendmmsg are available
+    the whole batch is read in one system call, and replies produced during
+    an event loop iteration are sent together in one call as well.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.fd = sock.fileno()
+        if mmsg.MMSG_AVAILABLE:
+            self.receiver = mmsg.Receiver(RECV_BATCH, MAX_DNS_PACKET)
+            self.sender = mmsg.Sender(RECV_BATCH)
+        else:
+            self.receiver = self.sender = None
+            self.buffer = bytearray(MAX_DNS_PACKET)
+            self.view = memoryview(self.buffer)
+        # Replies waiting for the end of this event loop iteration
+        self.outgoing: List[Tuple[bytes, Tuple[str, int]]] = []
+        # Queries still waiting on the upstream server
+        self.forwards: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        asyncio.get_running_loop().add_reader(self.fd, self.read_ready)
         logging.info(f"DNS server listening on {LISTEN_HOST}:{LISTEN_PORT}")
 
+    async def close(self) -> None:
+        """Stop serving, cancelling the queries still waiting on upstream."""
+        asyncio.get_running_loop().remove_reader(self.fd)
+        for task in self.forwards:
+            task.cancel()
+        await asyncio.gather(*self.forwards, return_exceptions=True)
+        if self.outgoing:
+            self.flush()
+        self.sock.close()
+
+    def read_ready(self) -> None:
+        if self.receiver is not None:
+            try:
+                datagrams = self.receiver.recv(self.fd)
+            except OSError as e:
+                logging.error(f"Error receiving DNS query: {e}")
+                return
+            for data, addr in datagrams:
+                self.datagram_received(data, addr)
+            return
+
+        for _ in range(RECV_BATCH):
+            try:
+                nbytes, addr = self.sock.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error(f"Error receiving DNS query: {e}")
+                return
+            self.datagram_received(self.view[:nbytes].tobytes(), addr)
+
     def datagram_received(self, data, addr):
-        asyncio.create_task(self.handle_query(data, addr))
+        try:
+            qname, question = read_question(data)
+            domain = qname.decode("ascii", "backslashreplace") + "."
+            if BLOOM.check_dns_qname(qname):
+                # Blocked names are answered right here, without a task
+                self.sendto(build_reply(data, question, BLOCKED_FLAGS, SINKHOLE_ANSWER), addr)
+                log_query_nowait(client_ip=addr[0], domain=domain, blocked=1, success=1)
+                return
+            key = cache_key(data, question)
+            cached = RESPONSE_CACHE.get(key) if key is not None else None
+            if cached is not None:
+                # Answered before and still fresh; only the txid differs
+                self.sendto(data[:2] + cached[2:], addr)
+                log_query_nowait(client_ip=addr[0], domain=domain, blocked=0, success=1)
+                return
+        except Exception as e:
+            logging.error(f"Error handling DNS query: {e}")
+            return
+        task = asyncio.create_task(self.forward_and_reply(data, addr, question, domain, key))
+        self.forwards.add(task)
+        task.add_done_callback(self.forwards.discard)
+
+    def sendto(self, data, addr):
+        if self.sender is not None:
+            if not self.outgoing:
+                asyncio.get_running_loop().call_soon(self.flush)
+            self.outgoing.append((data, addr))
+            return
+
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            # Send buffer full; the client will retry
+            logging.warning(f"Dropped DNS reply to {addr[0]}: send buffer full")
+        except OSError as e:
+            logging.error(f"Error sending DNS reply: {e}")
+
+    def flush(self) -> None:
+        """Send the queued replies with as few sendmmsg calls as possible."""
+        outgoing, self.outgoing = self.outgoing, []
+        while outgoing:
+            try:
+                sent = self.sender.send(self.fd, outgoing)
+            except OSError as e:
+                logging.error(f"Error sending DNS reply: {e}")
+                sent = 1  # skip the reply that failed
+            if sent == 0:
+                # Send buffer full; the clients will retry
+                logging.warning(f"Dropped {len(outgoing)} DNS replies: send buffer full")
+                return
+            del outgoing[:sent]
 
-    async def handle_query(self, data, addr):
+    async def forward_and_reply(self, data, addr, question, domain, key):
+        """Relay a query that is not blocked to UPSTREAM_DNS and send back its answer."""
         try:
-            request = DNSRecord.parse(data)
-            qname = request.q.qname
-            qtype = QTYPE[request.q.qtype]
-            client_ip = addr[0]
-            if BLOOM.check_url(str(qname)):
-                reply = DNSRecord(
-                    DNSHeader(id=request.header.id, qr=1, aa=1, ra=1),
-                    q=request.q
-                )
-                reply.add_answer(
-                    RR(rname=qname, rtype=QTYPE.A, rclass=1, ttl=60, rdata=A(SINKHOLE_IP))
-                )
-                response_data = reply.pack()
-                await log_query(client_ip=client_ip, domain=str(qname), blocked=1, success=1)
+            response_data = await forward_query(data, question)
+            success=1
+            if response_data is not None:
+                if key is not None:
+                    RESPONSE_CACHE.put(key, response_data)
             else:
-                response_data = await forward_query(data)
-                success=1
-                if response_data is None:
-                    success=0
-                    reply = DNSRecord(
-                        DNSHeader(id=request.header.id, qr=1, ra=1, rcode=2),
-                        q=request.q
-                    )
-                    response_data = reply.pack()
-                await log_query(client_ip=client_ip,domain=str(qname),blocked=0, success=success)
-
-            self.transport.sendto(response_data, addr)
+                success=0
+                response_data = build_reply(data, question, SERVFAIL_FLAGS)
+            log_query_nowait(client_ip=addr[0], domain=domain, blocked=0, success=success)
+
+            self.sendto(response_data, addr)
         except Exception as e:
             logging.error(f"Error handling DNS query: {e}")
 
 
-async def setup_logging():
+def setup_logging():
     try:
         # Make sure the directory exists for the log file
         log_dir = os.path.dirname(LOG_FILE)
@@ -149,23 +490,90 @@ async def setup_logging():
             f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Error setting up logging: {str(e)}\n")
 
 
+def make_listen_socket() -> socket.socket:
+    """Create the UDP listening socket.
+
+    SO_REUSEPORT lets every worker bind its own socket to the same port;
+    the kernel then spreads incoming packets across them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((LISTEN_HOST, LISTEN_PORT))
+    sock.setblocking(False)
+    return sock
+
+
 async def start_dns_server():
-    await setup_logging()
-    global BLOOM
-    BLOOM = initialize_bloom(blocklist_url)
-    uvloop.install()
+    """Serve DNS queries on this process's own listening socket until SIGTERM."""
+    global UPSTREAM
+    await init_db()
     loop = asyncio.get_running_loop()
-    listen_addr = (LISTEN_HOST, LISTEN_PORT)
-    transport, protocol = await loop.create_datagram_endpoint(
-        lambda: DnsServerProtocol(),
-        local_addr=listen_addr
+    upstream_transport, UPSTREAM = await loop.create_datagram_endpoint(
+        UpstreamClient,
+        remote_addr=UPSTREAM_DNS
     )
+    server = DnsServer(make_listen_socket())
+    server.start()
+    # Exit cleanly on SIGTERM so buffered query logs are flushed
+    stop_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except KeyboardInterrupt:
+        await stop_event.wait()
         logging.info("Shutting down the DNS sinkhole server.")
     finally:
-        transport.close()
+        # Cancel the forwards before closing the upstream socket fails them,
+        # so none of them logs a query after the database is closed
+        await server.close()
+        upstream_transport.close()
+        await close_db()
 
 
+def run_event_loop(coro) -> None:
+    """Run coro to completion, on uvloop when it is available."""
+    if uvloop is not None:
+        uvloop.run(coro)
+    else:
+        asyncio.run(coro)
+
+
+async def load_blocklist():
+    """Load the configured blocklist, returning None if that fails."""
+    return await initialize_bloom(blocklist_url, exact=EXACT_BLOCKLIST,
+                            match_subdomains=BLOCK_SUBDOMAINS)
+
+
+def run_dns_server(num_workers: int = DNS_WORKERS, bloom=None) -> None:
+    """Run the DNS server in num_workers processes.
+
+    The blocklist is loaded once, before forking, so every worker starts
+    with it already in memory; pass bloom to use one loaded by the caller.
+    This process serves as the first worker and stops the others when it
+    receives SIGTERM.
+    """
+    setup_logging()
+    global BLOOM
+    BLOOM = bloom if bloom is not None else asyncio.run(load_blocklist())
+    if BLOOM is None:
+        logging.error("Could not load the blocklist, not starting the DNS server")
+        sys.exit(1)
+
+    workers = []
+    for _ in range(num_workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_event_loop(start_dns_server())
+            finally:
+                os._exit(0)
+        workers.append(pid)
+
+    try:
+        run_event_loop(start_dns_server())
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)
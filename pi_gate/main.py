@@ -1,87 +1,146 @@
-from multiprocessing import Process
 import asyncio
+import fcntl
 import os
+import select
 import signal
 import sys
-import fcntl
-from .dashboard import start_dashboard
-from .database import init_db
-from .dns_server_async import start_dns_server
+import time
+from typing import Dict, List, Optional
+from .database import init_db, close_db
+from .dns_server_async import load_blocklist
 
 PID_FILE = "/tmp/pi_gate.pid"
+LOG_FILE = "/tmp/pi_gate.log"
+STOP_TIMEOUT = 5  # seconds to wait after SIGTERM before sending SIGKILL
 
 
-def start_dns():
-    """Run the async DNS server"""
-    # Write PID to the main PID file using file locking to avoid race conditions
-    with open(PID_FILE, "a") as f:
-        fcntl.flock(f, fcntl.LOCK_EX)  # Exclusive lock
-        f.write(f"{os.getpid()}\n")
-        fcntl.flock(f, fcntl.LOCK_UN)  # Release lock
-    
-    asyncio.run(start_dns_server())
-
-def start_dash():
-    """Run the dashboard"""
-    # Write PID to the main PID file using file locking
-    with open(PID_FILE, "a") as f:
-        fcntl.flock(f, fcntl.LOCK_EX)  # Exclusive lock
-        f.write(f"{os.getpid()}\n")
-        fcntl.flock(f, fcntl.LOCK_UN)  # Release lock
-    
-    start_dashboard()
+def lock_pid_file() -> Optional[int]:
+    """Open PID_FILE and take an exclusive lock on it.
 
-def daemonize(func):
-    """Daemonize a function using os.fork()"""
-    pid = os.fork()
-    if pid > 0:
-        return  # Exit first parent
-    
-    os.setsid()  # Create a new session, detach from terminal
-    
-    pid = os.fork()
-    if pid > 0:
-        sys.exit(0)  # Exit second parent
-    
-    # We're now in the grandchild process
-    func()  # Run the actual function
+    Returns the locked descriptor, or None if another pi-gate instance
+    already holds the lock.
+    """
+    fd = os.open(PID_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
 
-async def start_services():
-    """Start DNS server and dashboard in background"""
-    await init_db()
-    
-    # Clear the PID file first
-    with open(PID_FILE, "w") as f:
-        pass  # Create empty file
-    
-    # Start processes with daemonization
-    dns_process = Process(target=daemonize, args=(start_dns,), daemon=False)
-    dash_process = Process(target=daemonize, args=(start_dash,), daemon=False)
+def spawn_daemon(name: str, log_fd: int) -> int:
+    """Start the named pi_gate.worker daemon in a new session and return its PID.
+
+    posix_spawn starts a fresh interpreter without first copying this
+    process the way fork does. The child's stdin is /dev/null and its
+    stdout and stderr are pointed at log_fd; any other inheritable
+    descriptor stays open in it.
+    """
+    return os.posix_spawn(
+        sys.executable,
+        [sys.executable, "-m", "pi_gate.worker", name],
+        os.environ,
+        file_actions=[
+            (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+            (os.POSIX_SPAWN_DUP2, log_fd, 1),
+            (os.POSIX_SPAWN_DUP2, log_fd, 2),
+        ],
+        setsid=True,  # Detach from the terminal
+    )
+
+async def start_services() -> bool:
+    """Start DNS server and dashboard in background.
+
+    Returns False if pi-gate is already running. Raises RuntimeError if the
+    blocklist can't be loaded.
+    """
+    pid_fd = lock_pid_file()
+    if pid_fd is None:
+        return False
+
+    # Load the blocklist while the schema is created. Doing it here saves
+    # the filter for the DNS daemon to map straight from disk, and a
+    # failure is reported here rather than inside a detached process
+    bloom, _ = await asyncio.gather(load_blocklist(), init_db())
+    await close_db()
+    if bloom is None:
+        os.close(pid_fd)
+        raise RuntimeError("Failed to load the blocklist")
     
-    dns_process.start()
-    dash_process.start()
+    # One O_APPEND descriptor shared by both daemons; appends are atomic,
+    # so their output interleaves without extra locking
+    log_fd = os.open(LOG_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    # Both daemons also inherit pid_fd, so the lock is held for as long as
+    # either of them is alive
+    os.set_inheritable(pid_fd, True)
+    dns_pid = spawn_daemon("dns", log_fd)
+    dash_pid = spawn_daemon("dashboard", log_fd)
+    os.close(log_fd)
     
-    # Wait for immediate process to exit
-    dns_process.join()
-    dash_process.join()
+    os.ftruncate(pid_fd, 0)
+    os.write(pid_fd, f"{dns_pid}\n{dash_pid}\n".encode())
+    os.close(pid_fd)
     
     print(f"Started DNS server and Dashboard as daemons")
     print(f"PIDs written to {PID_FILE}")
+    return True
+
+def wait_for_exit(pidfds: Dict[str, int], timeout: float) -> List[str]:
+    """Wait for processes to exit, returning the PIDs still running after timeout.
+
+    A pidfd becomes readable once its process terminates, so this sleeps in
+    select() instead of polling the PIDs.
+    """
+    remaining = dict(pidfds)
+    deadline = time.monotonic() + timeout
+    while remaining:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        ready, _, _ = select.select(list(remaining.values()), [], [], left)
+        for pid in [pid for pid, fd in remaining.items() if fd in ready]:
+            del remaining[pid]
+    return list(remaining)
 
 def stop_services():
     """Stop services by reading the PID file"""
-    if not os.path.exists(PID_FILE):
+    try:
+        fd = os.open(PID_FILE, os.O_RDONLY)
+    except FileNotFoundError:
         print("pi-gate is not running!")
         return
 
-    with open(PID_FILE, "r") as f:
-        pids = f.read().strip().split("\n")
+    with os.fdopen(fd, "r") as f:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pids = f.read().split()
+        else:
+            # Nobody holds the lock, so the PID file is stale
+            print("pi-gate is not running (removing stale PID file).")
+            os.remove(PID_FILE)
+            return
 
+    # Signal through pidfds so a recycled PID can never be hit by mistake
+    pidfds = {}
     for pid in pids:
         try:
-            os.kill(int(pid), signal.SIGTERM)
-            print(f"Stopped process {pid}")
+            pidfds[pid] = os.pidfd_open(int(pid))
         except ProcessLookupError:
             print(f"Process {pid} not found, ignoring.")
 
+    try:
+        for fd in pidfds.values():
+            signal.pidfd_send_signal(fd, signal.SIGTERM)
+
+        for pid in wait_for_exit(pidfds, STOP_TIMEOUT):
+            signal.pidfd_send_signal(pidfds[pid], signal.SIGKILL)
+            print(f"Process {pid} did not exit in time, killed it.")
+
+        for pid in pidfds:
+            print(f"Stopped process {pid}")
+    finally:
+        for fd in pidfds.values():
+            os.close(fd)
+
     os.remove(PID_FILE)
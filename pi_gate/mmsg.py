@@ -0,0 +1,149 @@
+"""
+Batched UDP receive and send through recvmmsg(2) and sendmmsg(2).
+
+The socket module has no wrappers for these calls, so they are made through
+ctypes with preallocated message headers. Only IPv4 sockets are supported.
+MMSG_AVAILABLE is False where libc lacks the calls (anything but Linux), in
+which case callers should stick to recvfrom/sendto.
+"""
+import ctypes
+import ctypes.util
+import errno
+import functools
+import os
+import socket
+import struct
+from typing import List, Tuple
+
+Address = Tuple[str, int]
+
+SOCKADDR_IN_SIZE = 16
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+
+# Nothing was ready, or the socket buffer is full
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _sendmmsg = _libc.sendmmsg
+except (OSError, AttributeError, TypeError):
+    MMSG_AVAILABLE = False
+else:
+    MMSG_AVAILABLE = True
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                          ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                          ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+
+def _raise_errno() -> None:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+@functools.lru_cache(maxsize=1024)
+def _pack_sockaddr(addr: Address) -> bytes:
+    """Encode an (ip, port) pair as a struct sockaddr_in."""
+    return (struct.pack("=H", socket.AF_INET) + struct.pack(">H", addr[1])
+            + socket.inet_aton(addr[0]) + bytes(8))
+
+
+class _MessageArray:
+    """size message headers, each with one iovec and its own address slot."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.msgs = (_MMsgHdr * size)()
+        self.iovecs = (_IOVec * size)()
+        self.names = (ctypes.c_char * SOCKADDR_IN_SIZE * size)()
+        self.name_addrs = [ctypes.addressof(name) for name in self.names]
+        for i, msg in enumerate(self.msgs):
+            msg.msg_hdr.msg_name = self.name_addrs[i]
+            msg.msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+            msg.msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            msg.msg_hdr.msg_iovlen = 1
+
+
+class Receiver(_MessageArray):
+    """Receives up to size datagrams of at most bufsize bytes per call."""
+
+    def __init__(self, size: int, bufsize: int):
+        super().__init__(size)
+        self.buffers = (ctypes.c_char * bufsize * size)()
+        self.buffer_addrs = [ctypes.addressof(buffer) for buffer in self.buffers]
+        for iovec, addr in zip(self.iovecs, self.buffer_addrs):
+            iovec.iov_base = addr
+            iovec.iov_len = bufsize
+
+    def recv(self, fd: int) -> List[Tuple[bytes, Address]]:
+        """Return the datagrams queued on fd without blocking.
+
+        Datagrams too large for the buffers are dropped.
+        """
+        for msg in self.msgs:
+            msg.msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+        count = _recvmmsg(fd, self.msgs, self.size, MSG_DONTWAIT, None)
+        if count < 0:
+            if ctypes.get_errno() in _RETRY_ERRNOS:
+                return []
+            _raise_errno()
+
+        received = []
+        for i in range(count):
+            msg = self.msgs[i]
+            if msg.msg_hdr.msg_flags & MSG_TRUNC:
+                continue
+            data = ctypes.string_at(self.buffer_addrs[i], msg.msg_len)
+            name = ctypes.string_at(self.name_addrs[i], SOCKADDR_IN_SIZE)
+            addr = (socket.inet_ntoa(name[4:8]), struct.unpack_from(">H", name, 2)[0])
+            received.append((data, addr))
+        return received
+
+
+class Sender(_MessageArray):
+    """Sends up to size datagrams per call."""
+
+    def send(self, fd: int, messages: List[Tuple[bytes, Address]]) -> int:
+        """Send the leading messages in one call and return how many went out.
+
+        Returns 0 if the socket buffer is full. Raises OSError if the first
+        message could not be sent.
+        """
+        count = min(len(messages), self.size)
+        for i in range(count):
+            data, addr = messages[i]
+            # Point straight at the bytes object; messages keeps it alive
+            self.iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+            self.iovecs[i].iov_len = len(data)
+            ctypes.memmove(self.name_addrs[i], _pack_sockaddr(addr), SOCKADDR_IN_SIZE)
+        sent = _sendmmsg(fd, self.msgs, count, 0)
+        if sent < 0:
+            if ctypes.get_errno() in _RETRY_ERRNOS:
+                return 0
+            _raise_errno()
+        return sent
@@ -0,0 +1,26 @@
+"""
+Entry point of the pi-gate daemons, spawned by start_services.
+
+Usage: python -m pi_gate.worker {dns,dashboard}
+
+Each daemon imports only what it runs, so the DNS server never loads dash.
+"""
+import sys
+
+
+def start_dns():
+    """Run the async DNS server"""
+    from .dns_server_async import run_dns_server
+    run_dns_server()
+
+def start_dash():
+    """Run the dashboard"""
+    from .dashboard import start_dashboard
+    start_dashboard()
+
+DAEMONS = {"dns": start_dns, "dashboard": start_dash}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in DAEMONS:
+        sys.exit(f"usage: python -m pi_gate.worker {{{','.join(DAEMONS)}}}")
+    DAEMONS[sys.argv[1]]()
@@ -1,20 +1,46 @@
 #!/usr/bin/env python3
 import dns.resolver
 import dns.message
-import dns.query
+import dns.exception
+import dns.rcode
 import time
 import argparse
+import collections
 import statistics
-import concurrent.futures
+import asyncio
 import socket
 import random
 import string
 import csv
+import heapq
+import itertools
+import math
 import os
+import select
+import sys
+import threading
 from datetime import datetime
 
+try:
+    # Batched mode reuses pi-gate's ctypes wrappers for sendmmsg/recvmmsg;
+    # install pi-gate or run this as "python -m utils.benchmark" from the
+    # repository root
+    from pi_gate import mmsg
+except ImportError:
+    mmsg = None
+
+BATCHING_AVAILABLE = sys.platform == "linux" and mmsg is not None and mmsg.MMSG_AVAILABLE
+
+try:
+    # io_uring mode needs the liburing bindings (pip install liburing)
+    import liburing
+except ImportError:
+    liburing = None
+
+IOURING_AVAILABLE = sys.platform == "linux" and liburing is not None
+
 # List of real domains to test (both popular and less common)
-REAL_DOMAINS = [
+REAL_DOMAINS = (
     "google.com", "facebook.com", "amazon.com", "youtube.com", "twitter.com",
     "instagram.com", "linkedin.com", "reddit.com", "netflix.com", "tiktok.com",
     "wikipedia.org", "github.com", "apple.com", "microsoft.com", "yahoo.com",
@@ -23,133 +49,563 @@ REAL_DOMAINS = [
     "imdb.com", "booking.com", "airbnb.com", "uber.com", "lyft.com",
     "nasa.gov", "nih.gov", "stackoverflow.com", "medium.com", "quora.com",
     "craigslist.org", "weather.com", "yelp.com", "tripadvisor.com", "adobe.com"
-]
+)
+
+# Characters and TLDs of the random domain names
+ALPHA_DIGITS_HYPHEN = string.ascii_lowercase + string.digits + '-'
+TLDS = ['.com', '.net', '.org', '.io', '.co', '.xyz']
+
+QUERY_TIMEOUT = 3  # seconds
+
+# Most common failure reasons listed by print_stats
+FAILURE_REASONS_SHOWN = 5
+
+# Above this many queries, counting the unique domains isn't worth a set of them all
+UNIQUE_COUNT_LIMIT = 10_000
+
+# user_data of io_uring sends and timeouts; receives carry their buffer slot
+_SEND_TAG = 1 << 32
+_TIMEOUT_TAG = 1 << 33
+
+# Each thread reuses one socket (or TCP connection) for all of its queries
+# instead of opening a new one per query
+_thread_state = threading.local()
+
+def get_socket(server_ip, port=53, tcp=False):
+    """Return this thread's socket connected to the server, creating it on first use."""
+    sock = getattr(_thread_state, "sock", None)
+    if sock is None or _thread_state.server != (server_ip, port, tcp):
+        close_socket()
+        if tcp:
+            sock = socket.create_connection((server_ip, port), QUERY_TIMEOUT)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((server_ip, port))
+        _thread_state.sock = sock
+        _thread_state.server = (server_ip, port, tcp)
+    return sock
+
+def close_socket():
+    """Close this thread's socket, if any, so the next query opens a new one."""
+    sock = getattr(_thread_state, "sock", None)
+    if sock is not None:
+        sock.close()
+        _thread_state.sock = None
+
+def prepare_queries(domains, record_type):
+    """Serialize a query for every domain up front, outside the timed region.
 
-def generate_random_domain(tld=None):
-    """Generate a random domain name that likely doesn't exist."""
-    length = random.randint(8, 15)
-    domain = ''.join(random.choices(string.ascii_lowercase + string.digits + '-', k=length))
-    tld = tld or random.choice(['.com', '.net', '.org', '.io', '.co', '.xyz'])
-    return f"{domain}{tld}"
+    Returns a list of (domain, wire, message id) tuples. Ids count up from
+    0, wrapping at 65536, so they never collide among queries in flight.
+    """
+    rdtype = dns.rdatatype.from_text(record_type)
+    queries = []
+    for i, domain in enumerate(domains):
+        query = dns.message.make_query(domain, rdtype)
+        query.id = i & 0xFFFF
+        queries.append((domain, query.to_wire(), query.id))
+    return queries
+
+def exchange(sock, wire, msg_id):
+    """Send a query on a connected socket and return the matching response.
+
+    Late replies to earlier queries that timed out may still arrive on a
+    reused socket, so anything with a different message id is skipped.
+    """
+    deadline = time.monotonic() + QUERY_TIMEOUT
+    sock.send(wire)
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise dns.exception.Timeout()
+        sock.settimeout(remaining)
+        try:
+            data = sock.recv(65535)
+        except socket.timeout:
+            raise dns.exception.Timeout()
+        response = dns.message.from_wire(data)
+        if response.id == msg_id:
+            return response
+
+def _recv_exactly(sock, size, deadline):
+    """Read exactly size bytes from a stream socket before deadline."""
+    data = bytearray()
+    while len(data) < size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise dns.exception.Timeout()
+        sock.settimeout(remaining)
+        try:
+            chunk = sock.recv(size - len(data))
+        except socket.timeout:
+            raise dns.exception.Timeout()
+        if not chunk:
+            raise ConnectionResetError("Connection closed by server")
+        data += chunk
+    return bytes(data)
+
+def exchange_tcp(sock, wire, msg_id):
+    """Send a query over a TCP connection and return the matching response.
+
+    Messages carry the two-byte length prefix of DNS over TCP. Responses
+    to earlier queries are skipped, as over UDP.
+    """
+    deadline = time.monotonic() + QUERY_TIMEOUT
+    sock.sendall(len(wire).to_bytes(2, "big") + wire)
+    while True:
+        size = int.from_bytes(_recv_exactly(sock, 2, deadline), "big")
+        response = dns.message.from_wire(_recv_exactly(sock, size, deadline))
+        if response.id == msg_id:
+            return response
+
+def generate_random_domains(count):
+    """Generate count random domain names that likely don't exist.
+
+    All the random characters are drawn in one call and sliced into names.
+    """
+    lengths = [random.randint(8, 15) for _ in range(count)]
+    pool = ''.join(random.choices(ALPHA_DIGITS_HYPHEN, k=sum(lengths)))
+    tlds = random.choices(TLDS, k=count)
+    ends = itertools.accumulate(lengths)
+    return [pool[end - length:end] + tld for end, length, tld in zip(ends, lengths, tlds)]
 
 def generate_domain_list(real_count=40, random_count=60, include_nonexistent=True):
     """Generate a mix of real and random domain names."""
-    domains = []
-    
-    # Add real domains
-    if real_count > 0:
-        domains.extend(random.sample(REAL_DOMAINS, min(real_count, len(REAL_DOMAINS))))
+    real = random.sample(REAL_DOMAINS, min(max(real_count, 0), len(REAL_DOMAINS)))
+    # Random (likely nonexistent) domains
+    fake = generate_random_domains(random_count) if include_nonexistent and random_count > 0 else []
     
-    # Add random (likely nonexistent) domains
-    if include_nonexistent and random_count > 0:
-        for _ in range(random_count):
-            domains.append(generate_random_domain())
-            
-    # Shuffle the domains
+    # Build the list in one go, then shuffle it once
+    domains = [*real, *fake]
     random.shuffle(domains)
     return domains
 
-def perform_dns_query(server_ip, domain, record_type="A"):
-    """Perform a single DNS query to the specified server using lower-level DNS functions."""
+# One query's outcome; time is in milliseconds, error says why it failed
+QueryResult = collections.namedtuple("QueryResult", "domain success time has_answer error")
+
+def make_result(domain, response, elapsed_ns):
+    """Build the result record for a query that got a response.
+
+    Nothing is printed here, as this runs inside the timed loops; why a
+    query failed is kept in error for print_stats to summarize.
+    """
+    success = response.answer != []
+    error = None if success else f"{dns.rcode.to_text(response.rcode())}, no answer"
+    # Convert to milliseconds
+    return QueryResult(domain, success, elapsed_ns / 1e6, success, error)
+
+def make_error_result(domain, error):
+    """Build the result record for a query that failed."""
+    return QueryResult(domain, False, 0, False, str(error))
+
+def make_query_fn(server_ip, tcp=False):
+    """Return a function performing single DNS queries to server_ip.
+
+    The server and transport stay fixed for a whole run, so they, and
+    everything the query path calls, are bound to locals of the closure
+    up front instead of being looked up as globals on every query.
+    """
+    _get_socket = get_socket
+    _close_socket = close_socket
+    _exchange = exchange_tcp if tcp else exchange
+    _perf_counter_ns = time.perf_counter_ns
+    _make_result = make_result
+    _make_error_result = make_error_result
+
+    def perform_dns_query(domain, wire, msg_id):
+        """Perform a single DNS query to the server using lower-level DNS functions."""
+        try:
+            sock = _get_socket(server_ip, tcp=tcp)
+            
+            # Measure query time
+            start = _perf_counter_ns()
+            response = _exchange(sock, wire, msg_id)
+            elapsed_ns = _perf_counter_ns() - start
+            
+            return _make_result(domain, response, elapsed_ns)
+        except Exception as e:
+            if tcp:
+                # The stream may be left mid-message; start over on a new connection
+                _close_socket()
+            return _make_error_result(domain, e)
+
+    return perform_dns_query
+
+class DnsClientProtocol(asyncio.DatagramProtocol):
+    """One UDP socket shared by every in-flight query of the concurrent benchmark.
+
+    Responses can arrive in any order, so each is handed to the future
+    registered under its message id.
+    """
+
+    def __init__(self):
+        self.pending = {}  # message id -> future
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, wire):
+        self.transport.sendto(wire)
+
+    def datagram_received(self, data, addr):
+        self.response_received(data)
+
+    def response_received(self, data):
+        try:
+            response = dns.message.from_wire(data)
+        except Exception:
+            return
+        future = self.pending.pop(response.id, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        # Can't tell which query failed (e.g. ICMP port unreachable), so fail them all
+        self.fail_pending(exc)
+
+    def fail_pending(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+class DnsTcpClientProtocol(DnsClientProtocol, asyncio.Protocol):
+    """One TCP connection shared by every in-flight query, pipelined as RFC 7766 allows.
+
+    Messages carry a two-byte length prefix. The server may answer in any
+    order, so responses are matched by message id just as over UDP.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+
+    def send(self, wire):
+        self.transport.write(len(wire).to_bytes(2, "big") + wire)
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 2:
+            end = 2 + int.from_bytes(self.buffer[:2], "big")
+            if len(self.buffer) < end:
+                break
+            self.response_received(bytes(self.buffer[2:end]))
+            del self.buffer[:end]
+
+    def connection_lost(self, exc):
+        self.fail_pending(exc or ConnectionResetError("Connection closed by server"))
+
+async def perform_dns_query_async(protocol, domain, wire, msg_id, semaphore):
+    """Perform a single DNS query over the shared socket, at most semaphore-many at once."""
+    async with semaphore:
+        try:
+            future = asyncio.get_running_loop().create_future()
+            protocol.pending[msg_id] = future
+            
+            # Measure query time
+            start = time.perf_counter_ns()
+            protocol.send(wire)
+            try:
+                response = await asyncio.wait_for(future, QUERY_TIMEOUT)
+            finally:
+                protocol.pending.pop(msg_id, None)
+            elapsed_ns = time.perf_counter_ns() - start
+            
+            return make_result(domain, response, elapsed_ns)
+        except asyncio.TimeoutError:
+            return make_error_result(domain, dns.exception.Timeout())
+        except Exception as e:
+            return make_error_result(domain, e)
+
+def run_sequential_benchmark(server_ip, queries, tcp=False):
+    """Run DNS queries sequentially and measure performance.
+
+    With tcp, all queries go over one connection, opened on the first query.
+    """
+    perform_dns_query = make_query_fn(server_ip, tcp)
+    
+    start = time.perf_counter_ns()
+    results = list(itertools.starmap(perform_dns_query, queries))
+    total_time = (time.perf_counter_ns() - start) / 1e9
+    close_socket()
+    
+    return results, total_time
+
+async def _run_concurrent(server_ip, queries, max_in_flight, tcp, sockets):
+    loop = asyncio.get_running_loop()
+    transports = []
+    protocols = []
     try:
-        # Create a DNS query message
-        query = dns.message.make_query(domain, dns.rdatatype.from_text(record_type))
+        for _ in range(sockets):
+            if tcp:
+                transport, protocol = await loop.create_connection(
+                    DnsTcpClientProtocol, server_ip, 53
+                )
+            else:
+                transport, protocol = await loop.create_datagram_endpoint(
+                    DnsClientProtocol, remote_addr=(server_ip, 53)
+                )
+            transports.append(transport)
+            protocols.append(protocol)
+    except OSError as e:
+        for transport in transports:
+            transport.close()
+        return [make_error_result(domain, e) for domain, _, _ in queries]
+    try:
+        semaphore = asyncio.Semaphore(max_in_flight)
+        return await asyncio.gather(*(
+            perform_dns_query_async(protocols[i % sockets], domain, wire, msg_id, semaphore)
+            for i, (domain, wire, msg_id) in enumerate(queries)
+        ))
+    finally:
+        for transport in transports:
+            transport.close()
+
+def run_concurrent_benchmark(server_ip, queries, max_workers=20, tcp=False, sockets=1):
+    """Run DNS queries concurrently and measure performance.
+
+    Queries are dealt round-robin over sockets sockets on a single event
+    loop; max_workers caps how many are in flight at once. Each socket has
+    its own source port, so a server with SO_REUSEPORT listeners spreads
+    them over its workers rather than hashing everything to one. With
+    tcp, each socket is one connection that queries are pipelined over.
+    """
+    start = time.perf_counter_ns()
+    results = asyncio.run(_run_concurrent(server_ip, queries, max_workers, tcp, sockets))
+    total_time = (time.perf_counter_ns() - start) / 1e9
+    return results, total_time
+
+def run_batched_benchmark(server_ip, queries, batch_size=64):
+    """Run DNS queries in batches of one sendmmsg and a few recvmmsg calls each (Linux only).
+
+    Each batch is sent at once and its replies are collected before the
+    next one goes out, so response times are measured from the moment the
+    last sendmmsg call for the batch returned, matching io_uring mode.
+    """
+    server_addr = (server_ip, 53)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(server_addr)
+    sock.setblocking(False)
+    fd = sock.fileno()
+    sender = mmsg.Sender(batch_size)
+    receiver = mmsg.Receiver(batch_size, 4096)
+    # Each result goes to its query's index, whatever order replies come in
+    results = [None] * len(queries)
+    
+    start = time.perf_counter_ns()
+    for offset in range(0, len(queries), batch_size):
+        pending = {}  # message id -> index into queries
+        messages = []
+        for index in range(offset, min(offset + batch_size, len(queries))):
+            _, wire, msg_id = queries[index]
+            pending[msg_id] = index
+            messages.append((wire, server_addr))
         
-        # Measure query time
-        start_time = time.time()
-        response = dns.query.udp(query, server_ip, timeout=3, port=53)
-        end_time = time.time()
+        deadline = time.monotonic() + QUERY_TIMEOUT
+        error = dns.exception.Timeout()
+        try:
+            while messages and time.monotonic() < deadline:
+                sent = sender.send(fd, messages)
+                if sent == 0:
+                    # Send buffer full; wait until it drains
+                    select.select([], [sock], [], deadline - time.monotonic())
+                del messages[:sent]
+            # Stamped once the batch is out, like after io_uring_submit()
+            sent_ns = time.perf_counter_ns()
+            
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                    break
+                for data, _ in receiver.recv(fd):
+                    elapsed_ns = time.perf_counter_ns() - sent_ns
+                    try:
+                        response = dns.message.from_wire(data)
+                    except Exception:
+                        continue
+                    index = pending.pop(response.id, None)
+                    if index is not None:
+                        results[index] = make_result(queries[index][0], response, elapsed_ns)
+        except OSError as e:
+            # e.g. ECONNREFUSED when nothing listens on port 53; fail the
+            # rest of this batch and carry on with the next one
+            error = e
         
-        success = response.answer != []
-        if not success:
-            print("Failed resolution ", response)
-
-        return {
-            "domain": domain,
-            "success": success,
-            "time": (end_time - start_time) * 1000,  # Convert to milliseconds
-            "has_answer": success
-        }
-    except Exception as e:
-        return {
-            "domain": domain,
-            "success": False,
-            "time": 0,
-            "error": str(e)
-        }
-
-def run_sequential_benchmark(server, domains, record_type):
-    """Run DNS queries sequentially and measure performance."""
-    results = []
-    
-    start_time = time.time()
-    for domain in domains:
-        result = perform_dns_query(server, domain, record_type)
-        results.append(result)
-    total_time = time.time() - start_time
+        for index in pending.values():
+            results[index] = make_error_result(queries[index][0], error)
+    total_time = (time.perf_counter_ns() - start) / 1e9
     
+    sock.close()
     return results, total_time
 
-def run_concurrent_benchmark(server, domains, record_type, max_workers=20):
-    """Run DNS queries concurrently and measure performance."""
-    start_time = time.time()
-    results = []
-    
-    # Limit max_workers to avoid "Too many open files" error
-    max_workers = min(max_workers, 50)
+def _cqe_result(cqe):
+    """Return a completion's result, or the negated errno if it failed.
+
+    The bindings raise OSError when reading a negative result.
+    """
+    try:
+        return cqe.res
+    except OSError as e:
+        return -e.errno
+
+def run_iouring_benchmark(server_ip, queries, batch_size=64):
+    """Run DNS queries in batches submitted through an io_uring (Linux only).
+
+    Each batch queues one receive per query, each bounded by a linked
+    timeout, followed by all of its sends, and submits them with a single
+    io_uring_enter call. As in batched mode, response times are measured
+    from the moment the whole batch was submitted.
+    """
+    server_addr = (server_ip, 53)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(server_addr)
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    entries = 3 * batch_size  # receive, linked timeout and send per query
+    try:
+        # Only this thread touches the ring, so completion work can wait
+        # until we ask for it
+        liburing.io_uring_queue_init(
+            entries, ring,
+            liburing.IORING_SETUP_DEFER_TASKRUN | liburing.IORING_SETUP_SINGLE_ISSUER
+        )
+    except OSError:
+        # Kernels before 6.1 don't know these flags
+        liburing.io_uring_queue_init(entries, ring, 0)
+    # A registered socket skips the file reference counting on every
+    # operation; it's addressed as index 0 from here on
+    files = liburing.FileIndex([sock.fileno()])
+    liburing.io_uring_register_files(ring, files)
+    timeout = liburing.timespec(QUERY_TIMEOUT)
+    buffers = [bytearray(4096) for _ in range(batch_size)]
+    # Each result goes to its query's index, whatever order replies come in
+    results = [None] * len(queries)
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_domain = {
-            executor.submit(perform_dns_query, server, domain, record_type): domain 
-            for domain in domains
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_domain):
-            result = future.result()
-            results.append(result)
+    start = time.perf_counter_ns()
+    try:
+        for offset in range(0, len(queries), batch_size):
+            batch = range(offset, min(offset + batch_size, len(queries)))
+            for slot in range(len(batch)):
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_recv(sqe, 0, buffers[slot], 0)
+                liburing.io_uring_sqe_set_data64(sqe, slot)
+                liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE | liburing.IOSQE_IO_LINK)
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_link_timeout(sqe, timeout, 0)
+                liburing.io_uring_sqe_set_data64(sqe, _TIMEOUT_TAG)
+            
+            pending = {}  # message id -> index into queries
+            for index in batch:
+                _, wire, msg_id = queries[index]
+                pending[msg_id] = index
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_send(sqe, 0, wire, 0)
+                liburing.io_uring_sqe_set_data64(sqe, _SEND_TAG)
+                liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+            
+            liburing.io_uring_submit(ring)
+            sent_ns = time.perf_counter_ns()
+            
+            # Every receive completes, either with a datagram or cancelled
+            # by its timeout. Completions are taken one at a time from the
+            # head: the bindings don't wrap cqe[i] around the end of the ring
+            receiving = len(batch)
+            while receiving:
+                liburing.io_uring_wait_cqe(ring, cqe)
+                elapsed_ns = time.perf_counter_ns() - sent_ns
+                entry = cqe[0]
+                slot = entry.user_data
+                res = _cqe_result(entry)
+                liburing.io_uring_cqe_seen(ring, entry)
+                if slot >= _SEND_TAG:
+                    continue
+                receiving -= 1
+                if res <= 0:
+                    continue
+                try:
+                    response = dns.message.from_wire(bytes(buffers[slot][:res]))
+                except Exception:
+                    continue
+                index = pending.pop(response.id, None)
+                if index is not None:
+                    results[index] = make_result(queries[index][0], response, elapsed_ns)
+            
+            for index in pending.values():
+                results[index] = make_error_result(queries[index][0], dns.exception.Timeout())
+        total_time = (time.perf_counter_ns() - start) / 1e9
+    finally:
+        liburing.io_uring_queue_exit(ring)
+        sock.close()
     
-    total_time = time.time() - start_time
     return results, total_time
 
-def print_stats(results, total_time, num_requests, concurrent=False):
-    """Print statistics about the benchmark results."""
-    successful = sum(1 for r in results if r["success"])
-    resolved = sum(1 for r in results if r.get("has_answer", False))
-    response_times = [r["time"] for r in results if r["success"]]
+def print_stats(results, total_time, num_requests, concurrent=False, mode=None):
+    """Print statistics about the benchmark results.
+
+    Counts, sums and the samples are gathered in one pass over results;
+    the fastest and slowest queries are picked with heapq rather than by
+    sorting everything.
+    """
+    successful = resolved = 0
+    total = total_squares = 0.0
+    response_times = []
+    domains = []
+    failures = collections.Counter()
+    for domain, success, elapsed, has_answer, error in results:
+        if success:
+            successful += 1
+            response_times.append(elapsed)
+            domains.append(domain)
+            total += elapsed
+            total_squares += elapsed * elapsed
+        else:
+            failures[error or "Unknown error"] += 1
+        if has_answer:
+            resolved += 1
     
     if not response_times:
         print("No successful queries!")
-        errors = [r.get("error", "Unknown error") for r in results if not r["success"]]
-        if errors:
-            print(f"Sample error: {errors[0]}")
+        print_failures(failures)
         return
     
-    mode = "concurrent" if concurrent else "sequential"
+    mode = mode or ("concurrent" if concurrent else "sequential")
     print(f"\n--- {mode.upper()} BENCHMARK RESULTS ---")
     print(f"Total time: {total_time:.2f} seconds")
     print(f"Requests per second: {num_requests / total_time:.2f}")
     print(f"Success rate: {successful}/{num_requests} ({successful/num_requests*100:.2f}%)")
     print(f"Resolution rate: {resolved}/{num_requests} ({resolved/num_requests*100:.2f}%)")
     
+    mean = total / successful
     print(f"Response time stats (ms):")
     print(f"  Min:     {min(response_times):.2f}")
     print(f"  Max:     {max(response_times):.2f}")
-    print(f"  Average: {statistics.mean(response_times):.2f}")
+    print(f"  Average: {mean:.2f}")
     print(f"  Median:  {statistics.median(response_times):.2f}")
-    if len(response_times) > 1:
-        print(f"  StdDev:  {statistics.stdev(response_times):.2f}")
+    if successful > 1:
+        variance = max(total_squares - successful * mean * mean, 0.0) / (successful - 1)
+        print(f"  StdDev:  {math.sqrt(variance):.2f}")
     
     # Display sample of fastest and slowest domains
-    if len(response_times) > 5:
-        sorted_results = sorted([r for r in results if r["success"]], key=lambda x: x["time"])
+    if successful > 5:
+        timed = list(zip(response_times, domains))
         print("\nFastest queries:")
-        for i in range(min(3, len(sorted_results))):
-            print(f"  {sorted_results[i]['domain']}: {sorted_results[i]['time']:.2f}ms")
+        for elapsed, domain in heapq.nsmallest(3, timed):
+            print(f"  {domain}: {elapsed:.2f}ms")
         
         print("\nSlowest queries:")
-        for i in range(min(3, len(sorted_results))):
-            idx = len(sorted_results) - i - 1
-            print(f"  {sorted_results[idx]['domain']}: {sorted_results[idx]['time']:.2f}ms")
+        for elapsed, domain in heapq.nlargest(3, timed):
+            print(f"  {domain}: {elapsed:.2f}ms")
+    
+    print_failures(failures)
+
+def print_failures(failures):
+    """Print the most common reasons queries failed, if any did."""
+    if not failures:
+        return
+    print("\nFailure reasons:")
+    for reason, count in failures.most_common(FAILURE_REASONS_SHOWN):
+        print(f"  {count:>6}  {reason}")
 
 def save_results_to_csv(results, total_time, num_requests, filename=None):
     """Save the benchmark results to a CSV file."""
@@ -158,19 +614,12 @@ def save_results_to_csv(results, total_time, num_requests, filename=None):
         filename = f"dns_benchmark_{timestamp}.csv"
     
     with open(filename, 'w', newline='') as csvfile:
-        fieldnames = ['domain', 'success', 'time_ms', 'has_answer', 'error']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        
-        writer.writeheader()
-        for result in results:
-            row = {
-                'domain': result['domain'],
-                'success': result['success'],
-                'time_ms': result['time'] if result['success'] else 0,
-                'has_answer': result.get('has_answer', False),
-                'error': result.get('error', '') if not result['success'] else ''
-            }
-            writer.writerow(row)
+        writer = csv.writer(csvfile)
+        writer.writerow(('domain', 'success', 'time_ms', 'has_answer', 'error'))
+        writer.writerows(
+            (r.domain, r.success, r.time if r.success else 0, r.has_answer, r.error or '')
+            for r in results
+        )
     
     print(f"\nResults saved to {filename}")
     return filename
@@ -181,8 +630,13 @@ def main():
     parser.add_argument("--requests", type=int, default=100, help="Number of total requests to send (default: 100)")
     parser.add_argument("--type", default="A", help="Record type to query (default: A)")
     parser.add_argument("--concurrent", action="store_true", help="Run requests concurrently")
-    parser.add_argument("--workers", type=int, default=20, help="Max worker threads for concurrent mode (default: 20)")
+    parser.add_argument("--workers", type=int, default=20, help="Max queries in flight in concurrent mode (default: 20)")
+    parser.add_argument("--sockets", type=int, default=1, help="Client sockets to spread concurrent queries over (default: 1)")
+    parser.add_argument("--transport", choices=["udp", "tcp"], default="udp", help="Transport to query over (default: udp)")
     parser.add_argument("--sequential-only", action="store_true", help="Only run sequential benchmark")
+    parser.add_argument("--batched", action="store_true", help="Send queries in batches with sendmmsg/recvmmsg (Linux only)")
+    parser.add_argument("--io-uring", action="store_true", help="Send queries in batches through io_uring (Linux, needs liburing)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Queries per batch in batched and io_uring modes (default: 64)")
     parser.add_argument("--real-ratio", type=float, default=0.4, help="Ratio of real domains to use (0.0-1.0, default: 0.4)")
     parser.add_argument("--save-csv", action="store_true", help="Save results to CSV file")
     parser.add_argument("--csv-file", help="Custom filename for CSV results")
@@ -215,37 +669,72 @@ def main():
         domains = domains[:args.requests]
     
     print(f"Benchmarking DNS server at {args.server}:53")
-    print(f"Sending {len(domains)} {args.type} queries for {len(set(domains))} unique domains")
+    if len(domains) <= UNIQUE_COUNT_LIMIT:
+        print(f"Sending {len(domains)} {args.type} queries for {len(set(domains))} unique domains")
+    else:
+        print(f"Sending {len(domains)} {args.type} queries")
     
-    # Validate server is reachable before starting
+    # Resolve the server once; every mode connects to the address directly
     try:
-        socket.gethostbyname(args.server)
+        server_ip = socket.gethostbyname(args.server)
     except socket.gaierror:
         print(f"Error: Could not resolve server address '{args.server}'")
         return
     
     all_results = []
+    queries = prepare_queries(domains, args.type)
+    tcp = args.transport == "tcp"
     
-    if args.concurrent:
+    if tcp and (args.batched or args.io_uring):
+        print("Batched and io_uring modes are UDP only, running in concurrent mode instead")
+        args.batched = args.io_uring = False
+        args.concurrent = True
+    
+    if args.io_uring and not IOURING_AVAILABLE:
+        print("liburing is not available here, running in batched mode instead")
+        args.io_uring = False
+        args.batched = True
+    
+    if args.batched and not BATCHING_AVAILABLE:
+        if mmsg is None:
+            print("pi_gate could not be imported (install pi-gate or run python -m utils.benchmark "
+                  "from the repository root), running in concurrent mode instead")
+        else:
+            print("sendmmsg/recvmmsg are not available here, running in concurrent mode instead")
+        args.concurrent = True
+    
+    if args.io_uring:
+        print(f"Running in io_uring mode with {args.batch_size} queries per batch")
+        results, total_time = run_iouring_benchmark(
+            server_ip, queries, args.batch_size
+        )
+        print_stats(results, total_time, len(domains), mode="io_uring")
+        all_results = results
+    elif args.batched and BATCHING_AVAILABLE:
+        print(f"Running in batched mode with {args.batch_size} queries per batch")
+        results, total_time = run_batched_benchmark(
+            server_ip, queries, args.batch_size
+        )
+        print_stats(results, total_time, len(domains), mode="batched")
+        all_results = results
+    elif args.concurrent:
         print(f"Running in concurrent mode with {args.workers} workers")
         results, total_time = run_concurrent_benchmark(
-            args.server, domains, args.type, args.workers
+            server_ip, queries, args.workers, tcp, args.sockets
         )
         print_stats(results, total_time, len(domains), concurrent=True)
         all_results = results
     else:
         print("Running in sequential mode")
-        results, total_time = run_sequential_benchmark(
-            args.server, domains, args.type
-        )
+        results, total_time = run_sequential_benchmark(server_ip, queries, tcp)
         print_stats(results, total_time, len(domains))
         all_results = results
     
     # Run both modes if not specified
-    if not args.concurrent and not args.sequential_only:
+    if not args.concurrent and not args.sequential_only and not args.batched and not args.io_uring:
         print("\nAlso running concurrent benchmark for comparison...")
         results, total_time = run_concurrent_benchmark(
-            args.server, domains, args.type, args.workers
+            server_ip, queries, args.workers, tcp, args.sockets
         )
         print_stats(results, total_time, len(domains), concurrent=True)
         all_results = results  # Use the concurrent results for CSV if we ran both
@@ -277,4 +766,16 @@ python benchmark.py --save-csv
 
 # High concurrency test
 python benchmark.py --concurrent --workers 40
+
+# Spread the load over the workers of a multi-process server
+python benchmark.py --concurrent --workers 40 --sockets 4
+
+# Reuse one TCP connection, pipelining queries in concurrent mode
+python benchmark.py --transport tcp
+
+# Batched sendmmsg/recvmmsg test (Linux only)
+python benchmark.py --batched --batch-size 100
+
+# io_uring test (Linux only, needs pip install liburing)
+python benchmark.py --io-uring --batch-size 100
 """
\ No newline at end of file